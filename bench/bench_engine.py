@@ -0,0 +1,218 @@
+"""Benchmarks the process engine against generated process tables
+
+Runs without Keypirinha and without windows, e.g.:
+
+    python bench/bench_engine.py
+    python bench/bench_engine.py --sizes 1000 10000 --repeat 5
+
+For every table size and phase the best wall time of all repetitions, the throughput in processes per second and
+the peak memory allocated by the phase (measured in a separate run with tracemalloc) are reported.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.engine import ProcessEngine, WAIT_OBJECT_0  # noqa: E402
+from lib.handles import cim_to_filetime  # noqa: E402
+from lib.replay import FixtureServiceBackend  # noqa: E402
+
+DESC_MAX_LENGTH = 300
+SERVICE_IMAGES = {"svchost.exe", "csrss.exe", "MsMpEng.exe"}
+IMAGES = ["svchost.exe", "chrome.exe", "code.exe", "node.exe", "java.exe", "explorer.exe", "conhost.exe",
+          "RuntimeBroker.exe", "python.exe", "Teams.exe", "slack.exe", "MsMpEng.exe", "csrss.exe"]
+
+
+def generate_rows(count, seed=0):
+    """Generates a process table with realistic names, paths and (partly very long) command lines
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for pid in range(4, 4 + count * 4, 4):
+        name = rnd.choice(IMAGES)
+        path = "C:\\Program Files\\{0}\\{1}".format(name[:-4], name) if rnd.random() < 0.8 else None
+        if path and rnd.random() < 0.7:
+            args = " ".join("--flag-{}={}".format(i, "x" * rnd.randint(1, 40)) for i in range(rnd.randint(0, 60)))
+            cmdline = '"{}" {}'.format(path, args)
+        else:
+            cmdline = None
+        session = 0 if name in SERVICE_IMAGES else 1
+        created = "20261018{:02d}{:02d}{:02d}.{:06d}+120".format(rnd.randint(0, 23), rnd.randint(0, 59),
+                                                                 rnd.randint(0, 59), rnd.randint(0, 999999))
+        rows.append({"ProcessId": pid, "Caption": name, "Name": name, "ExecutablePath": path, "CommandLine": cmdline,
+                     "SessionId": session, "CreationDate": created})
+    return rows
+
+
+SERVICES = ["Dnscache", "LanmanWorkstation", "EventLog", "Schedule", "BITS", "wuauserv", "Dhcp", "nsi",
+            "CryptSvc", "WinHttpAutoProxySvc", "Audiosrv", "Themes", "W32Time", "DPS", "WdiServiceHost"]
+
+
+def generate_services(rows, seed=0):
+    """Generates (pid, service name) for the svchost.exe processes of a generated process table
+    """
+    rnd = random.Random(seed)
+    return [(row["ProcessId"], rnd.choice(SERVICES))
+            for row in rows if row["Name"] == "svchost.exe"
+            for _ in range(rnd.choice([1, 1, 1, 2, 5]))]
+
+
+class FakeProcessBackend:
+    source = "fake"
+
+    def __init__(self, rows):
+        self._rows = rows
+        self.running = {row["ProcessId"] for row in rows}
+        self.created = {row["ProcessId"]: cim_to_filetime(row["CreationDate"]) for row in rows}
+
+    def list_processes(self):
+        return self._rows
+
+    def get_process(self, pid):
+        return next((row for row in self._rows if row["ProcessId"] == pid), None)
+
+    def is_running(self, pid):
+        return pid in self.running
+
+
+class FakeWindowBackend:
+    def __init__(self, rows, ratio=0.05, seed=0):
+        rnd = random.Random(seed)
+        self._windows = [(0x10000 + i, row["ProcessId"]) for i, row in enumerate(rows) if rnd.random() < ratio]
+
+    def list_windows(self):
+        return self._windows
+
+    def window_text(self, hwnd):
+        return "Window {:x}".format(hwnd)
+
+
+class FakeKillBackend:
+    def __init__(self, process_backend):
+        self._processes = process_backend
+
+    def open(self, pid, query=False):
+        return pid
+
+    def close(self, handle):
+        pass
+
+    def post_close(self, hwnd):
+        pass
+
+    def wait(self, handle, timeout_ms):
+        self._processes.running.discard(handle)
+        return WAIT_OBJECT_0
+
+    def remote_exit(self, handle):
+        return True
+
+    def creation_time(self, handle):
+        return self._processes.created.get(handle)
+
+    def terminate(self, handle):
+        return True
+
+
+def make_engine(rows):
+    processes = FakeProcessBackend(rows)
+    return ProcessEngine(process_backend=processes,
+                         window_backend=FakeWindowBackend(rows),
+                         kill_backend=FakeKillBackend(processes),
+                         service_backend=FixtureServiceBackend(generate_services(rows)))
+
+
+def phases(rows):
+    """Returns (name, setup, run) for every phase, setup prepares a fresh engine for run
+    """
+    def snapshot_ready():
+        engine = make_engine(rows)
+        engine.snapshot_windows()
+        engine.snapshot_processes()
+        return engine
+
+    def windows_ready():
+        engine = make_engine(rows)
+        engine.snapshot_windows()
+        return engine
+
+    def built_ready():
+        engine = windows_ready()
+        engine.snapshot_services()
+        engine.build(rows)
+        return engine
+
+    def ordered_ready():
+        engine = snapshot_ready()
+        engine.ordered()
+        return engine
+
+    def format_items(engine):
+        return [(p.label(), p.short_desc(DESC_MAX_LENGTH)) for p in engine.ordered()]
+
+    def filter_processes(engine):
+        engine.find_by_name("node.exe")
+        return engine.filter(lambda p: p.cmdline is not None and "flag-7" in p.cmdline)
+
+    def kill_by_name(engine):
+        return engine.kill_many([p.pid for p in engine.find_by_name("node.exe")])
+
+    return [
+        ("windows", lambda: make_engine(rows), lambda engine: engine.snapshot_windows()),
+        ("snapshot", lambda: make_engine(rows), lambda engine: engine.snapshot_processes()),
+        ("handles", built_ready, lambda engine: engine.refresh_handles(rows)),
+        ("sort", snapshot_ready, lambda engine: engine.ordered()),
+        ("format", ordered_ready, format_items),
+        ("filter", snapshot_ready, filter_processes),
+        ("kill_by_name", snapshot_ready, kill_by_name),
+    ]
+
+
+def measure(setup, run, repeat):
+    """Returns the best wall time of all repetitions and the peak memory of one extra traced run
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        engine = setup()
+        start = time.perf_counter()
+        run(engine)
+        best = min(best, time.perf_counter() - start)
+
+    engine = setup()
+    tracemalloc.start()
+    try:
+        run(engine)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>7} {:<14} {:>10} {:>14} {:>12}".format("procs", "phase", "ms", "procs/s", "peak KiB"))
+    for size in args.sizes:
+        rows = generate_rows(size)
+        for name, setup, run in phases(rows):
+            seconds, peak = measure(setup, run, args.repeat)
+            throughput = size / seconds if seconds else float("inf")
+            print("{:>7} {:<14} {:>10.2f} {:>14,.0f} {:>12,.1f}".format(size, name, seconds * 1000, throughput,
+                                                                        peak / 1024))
+
+        engine = make_engine(rows)
+        engine.snapshot_processes()
+        report = engine.memory_report()
+        print("{:>7} snapshot holds {:,.1f} KiB ({} bytes per process)".format(size, report["total_bytes"] / 1024,
+                                                                             report["bytes_per_process"]))
+
+
+if __name__ == "__main__":
+    main()
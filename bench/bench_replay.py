@@ -0,0 +1,147 @@
+"""Replays recorded process snapshots through the plugin's suggestion path and checks them against baselines
+
+Snapshots are written by the "Dump process snapshot (debug)" action (enable debug in kill.ini) into the package's
+cache directory. The plugin itself runs with the stubbed keypirinha modules of bench_startup.py and its process,
+window, service and icon sources pointed at the recording, so it runs without Keypirinha and without windows, e.g.:
+
+    python bench/bench_replay.py snapshot-20261018-120000.json.gz --update-baseline
+    python bench/bench_replay.py snapshot-20261018-120000.json.gz
+
+The baseline is stored next to the snapshot (<snapshot>.baseline.json). The run fails with exit code 1 if a phase
+takes longer than its baseline times the tolerance. --generate writes a synthetic snapshot to get started.
+
+Phases: "suggest" is the first on_suggest("") of a session (windows, processes, sort, icons and items), "filter" a
+second on_suggest with some text and "cleanup" the _cleanup when the box is closed.
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import replay  # noqa: E402
+from bench_engine import generate_rows, generate_services, FakeWindowBackend  # noqa: E402
+from bench_startup import install_stubs  # noqa: E402
+
+FILTER_INPUT = "exe"
+
+
+def load_plugin_module():
+    """Imports kill.py with the stubbed keypirinha modules
+    """
+    install_stubs()
+    return importlib.import_module("Kill.kill")
+
+
+def create_plugin(module, recording):
+    """Creates and starts the plugin with all its sources pointed at the recording
+    """
+    plugin = module.Kill()
+    plugin.on_start()
+    plugin._history_enabled = False
+    plugin._create_process_backend = lambda: replay.ReplayProcessBackend(recording)
+    plugin._engine.window_backend = replay.ReplayWindowBackend(recording)
+    plugin._engine.service_backend = replay.FixtureServiceBackend(recording.services)
+    # nothing is killed, so no handles are opened ahead of time either
+    plugin._engine.kill_backend = None
+    plugin._icons = module.IconCache(replay.ReplayIconLoader(recording), metrics=plugin._metrics, log=plugin)
+    return plugin
+
+
+def run_once(module, recording):
+    """Runs the plugin's suggestion path on the recording and returns the time per phase and the number of items
+    """
+    timings = {}
+    plugin = create_plugin(module, recording)
+    items_chain = [plugin.create_item(target="kill")]
+
+    start = time.perf_counter()
+    plugin.on_suggest("", items_chain)
+    timings["suggest"] = time.perf_counter() - start
+    count = len(plugin.suggestions)
+
+    start = time.perf_counter()
+    plugin.on_suggest(FILTER_INPUT, items_chain)
+    timings["filter"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plugin._cleanup()
+    timings["cleanup"] = time.perf_counter() - start
+    return timings, count
+
+
+def measure(module, recording, repeat):
+    """Returns the best time per phase over all repetitions in milliseconds
+    """
+    best = {}
+    count = 0
+    for _ in range(repeat):
+        timings, count = run_once(module, recording)
+        for phase, seconds in timings.items():
+            best[phase] = min(best.get(phase, float("inf")), seconds * 1000)
+    return best, count
+
+
+def generate(path, size):
+    rows = generate_rows(size)
+    windows = FakeWindowBackend(rows)
+    recording = replay.Recording()
+    recording.source = "generated"
+    recording.rows = rows
+    recording.windows = windows.list_windows()
+    recording.window_titles = {hwnd: windows.window_text(hwnd) for hwnd, _ in recording.windows}
+    recording.services = generate_services(rows)
+    recording.icons = {row["ExecutablePath"]: True for row in rows if row["ExecutablePath"]}
+    recording.save(path)
+    print("Generated snapshot with {} processes: {}".format(size, path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("snapshots", nargs="+")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="allowed factor over the baseline (default: 1.5)")
+    parser.add_argument("--slack-ms", type=float, default=1.0,
+                        help="absolute slack added to every baseline to absorb noise in tiny phases (default: 1.0)")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--generate", type=int, metavar="PROCESSES",
+                        help="write a synthetic snapshot with that many processes to every given path")
+    args = parser.parse_args()
+
+    if args.generate:
+        for path in args.snapshots:
+            generate(path, args.generate)
+        return 0
+
+    module = load_plugin_module()
+    failed = False
+    for path in args.snapshots:
+        recording = replay.Recording.load(path)
+        best, count = measure(module, recording, args.repeat)
+        baseline_path = path + ".baseline.json"
+        print("{} ({} processes, source: {})".format(path, count, recording.source))
+
+        if args.update_baseline or not os.path.exists(baseline_path):
+            with open(baseline_path, "w", encoding="utf-8") as baseline_file:
+                json.dump({phase: round(ms, 3) for phase, ms in best.items()}, baseline_file, indent=2, sort_keys=True)
+            for phase, ms in sorted(best.items()):
+                print("  {:<10} {:>10.2f} ms (baseline written)".format(phase, ms))
+            continue
+
+        with open(baseline_path, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        for phase, ms in sorted(best.items()):
+            allowed = baseline.get(phase, float("inf")) * args.tolerance + args.slack_ms
+            ok = ms <= allowed
+            failed = failed or not ok
+            print("  {:<10} {:>10.2f} ms (allowed {:>10.2f} ms) {}".format(phase, ms, allowed, "ok" if ok else "SLOWER"))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
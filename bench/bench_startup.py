@@ -0,0 +1,148 @@
+"""Measures how long it takes to import the plugin and to run its on_start with stubbed keypirinha modules
+
+Every sample runs in a fresh interpreter so the import is cold, e.g.:
+
+    python bench/bench_startup.py --samples 20
+
+Also lists the heavy modules that got loaded by import and on_start, there should be none.
+"""
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+import types
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["asyncio", "subprocess", "comtypes", "comtypes.client", "concurrent.futures", "json", "gzip",
+                 "ctypes.wintypes"]
+
+
+def install_stubs():
+    """Puts minimal keypirinha and keypirinha_util modules into sys.modules
+    """
+    kp = types.ModuleType("keypirinha")
+
+    class Settings:
+        def __getattr__(self, name):
+            def getter(key, section=None, fallback=None, *args, **kwargs):
+                return fallback
+            return getter
+
+    class Item:
+        __slots__ = ("_args",)
+
+        def __init__(self, **kwargs):
+            self._args = kwargs
+
+        def __getattr__(self, name):
+            if name not in ("category", "label", "short_desc", "target"):
+                raise AttributeError(name)
+            return lambda: self._args[name]
+
+    class Plugin:
+        def __init__(self):
+            self.suggestions = []
+
+        def dbg(self, *args):
+            pass
+
+        info = warn = err = dbg
+
+        def load_settings(self):
+            return Settings()
+
+        def create_action(self, **kwargs):
+            return types.SimpleNamespace(name=lambda: kwargs["name"], label=kwargs["label"])
+
+        def set_actions(self, category, actions):
+            pass
+
+        def create_item(self, **kwargs):
+            return Item(**kwargs)
+
+        def set_suggestions(self, suggestions, match_method=None, sort_method=None):
+            self.suggestions = suggestions
+
+        def set_catalog(self, catalog):
+            pass
+
+        def load_icon(self, source):
+            return types.SimpleNamespace(free=lambda: None)
+
+        def package_full_name(self):
+            return "Kill"
+
+        def get_package_cache_path(self, create=False):
+            return tempfile.gettempdir()
+
+    kp.Plugin = Plugin
+    kp.ItemCategory = types.SimpleNamespace(KEYWORD=1, USER_BASE=1000)
+    kp.ItemArgsHint = types.SimpleNamespace(REQUIRED=1, FORBIDDEN=2)
+    kp.ItemHitHint = types.SimpleNamespace(KEEPALL=1, IGNORE=2)
+    kp.Match = types.SimpleNamespace(FUZZY=1, ANY=2)
+    kp.Sort = types.SimpleNamespace(SCORE_DESC=1, NONE=2)
+    kp.Events = types.SimpleNamespace(PACKCONFIG=1)
+    sys.modules["keypirinha"] = kp
+
+    kpu = types.ModuleType("keypirinha_util")
+    sys.modules["keypirinha_util"] = kpu
+
+    package = types.ModuleType("Kill")
+    package.__path__ = [PACKAGE_DIR]
+    sys.modules["Kill"] = package
+
+
+def child():
+    """Runs one cold sample and prints its result as JSON
+    """
+    install_stubs()
+    before = set(sys.modules)
+
+    start = time.perf_counter()
+    module = importlib.import_module("Kill.kill")
+    import_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plugin = module.Kill()
+    plugin.on_start()
+    start_time = time.perf_counter() - start
+
+    loaded = sorted(name for name in HEAVY_MODULES if name in sys.modules and name not in before)
+    import json
+    print(json.dumps({"import": import_time, "on_start": start_time, "loaded": loaded}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return 0
+
+    # imported here, so a child doesn't have them loaded already
+    import json
+    import statistics
+    import subprocess
+
+    results = []
+    for _ in range(args.samples):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child"])
+        results.append(json.loads(output.decode("utf8").splitlines()[-1]))
+
+    for phase in ("import", "on_start"):
+        values = sorted(result[phase] * 1000 for result in results)
+        print("{:<9} median {:>7.2f} ms   min {:>7.2f} ms   max {:>7.2f} ms".format(
+            phase, statistics.median(values), values[0], values[-1]))
+
+    loaded = sorted({name for result in results for name in result["loaded"]})
+    print("heavy modules loaded:", ", ".join(loaded) if loaded else "none")
+    return 1 if loaded else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
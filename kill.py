@@ -1,34 +1,18 @@
-from .lib.alttab import AltTab
+from .lib.engine import ProcessEngine, ProcessPattern, IconCache
+from .lib.handles import HandlePool
+from .lib.history import KillHistory
+from .lib.rules import Matcher, ProcessRules
+from .lib.metrics import Metrics
+from .lib import win32
 import keypirinha as kp
 import keypirinha_util as kpu
-import subprocess
-import ctypes as ct
+import os
 import time
 import traceback
-import asyncio
 
-try:
-    import comtypes.client as com_cl
-except ImportError:
-    com_cl = None
-
-KERNEL = ct.windll.kernel32
-
-CommandLineToArgvW = ct.windll.shell32.CommandLineToArgvW
-CommandLineToArgvW.argtypes = [ct.wintypes.LPCWSTR, ct.POINTER(ct.c_int)]
-CommandLineToArgvW.restype = ct.POINTER(ct.wintypes.LPWSTR)
-
-PostMessageW = ct.windll.user32.PostMessageW
-PostMessageW.argtypes = [ct.wintypes.HWND, ct.c_uint, ct.wintypes.WPARAM, ct.wintypes.LPARAM]
-PostMessageW.restype = ct.c_long
-
-PROCESS_TERMINATE = 0x0001
-SYNCHRONIZE = 0x00100000
-WAIT_OBJECT_0 = 0x00000000
-WAIT_TIMEOUT = 0x00000102
-WAIT_FAILED = 0xFFFFFFFF
-WM_CLOSE = 0x0010
 RESTARTABLE = kp.ItemCategory.USER_BASE + 1
+PROTECTED = kp.ItemCategory.USER_BASE + 2
+BATCH = kp.ItemCategory.USER_BASE + 3
 
 
 class Kill(kp.Plugin):
@@ -42,20 +26,37 @@ class Kill(kp.Plugin):
     ACTION_KILL_BY_NAME_ADMIN = ACTION_KILL_BY_NAME + ADMIN_SUFFIX
     ACTION_COPY_CMD_LINE = "copy_cmd_line"
     ACTION_COPY_IMAGE_PATH = "copy_image_path"
+    ACTION_DUMP_SNAPSHOT = "dump_snapshot"
+    ACTION_KILL_BY_PATTERN = "kill_by_pattern"
     DEFAULT_ITEM_LABEL = "Kill:"
+    DEFAULT_DESC_MAX_LENGTH = 300
+    DEFAULT_BATCH_PREVIEW_COUNT = 5
+    DEFAULT_PROTECT_NAMES = ["csrss.exe", "smss.exe", "wininit.exe", "winlogon.exe", "services.exe", "lsass.exe",
+                             "lsaiso.exe", "MsMpEng.exe"]
 
     def __init__(self):
         """Default constructor and initializing internal attributes
         """
         super().__init__()
         self._processes = []
-        self._processes_with_window = {}
+        self._items_by_pid = {}
         self._actions = []
-        self._icons = {}
         self._default_action = self.ACTION_KILL_BY_ID
         self._hide_background = False
         self._default_icon = None
         self._item_label = self.DEFAULT_ITEM_LABEL
+        self._desc_max_length = self.DEFAULT_DESC_MAX_LENGTH
+        self._batch_preview_count = self.DEFAULT_BATCH_PREVIEW_COUNT
+        self._metrics = Metrics(log=self)
+        self._engine = ProcessEngine(window_backend=win32.AltTabWindowBackend(),
+                                     kill_backend=win32.Win32KillBackend(self),
+                                     metrics=self._metrics,
+                                     log=self)
+        self._icons = IconCache(self._load_exe_icon, metrics=self._metrics, log=self)
+        self._history = None
+        self._history_enabled = True
+        self._history_size = KillHistory.DEFAULT_MAX_ENTRIES
+        self._history_half_life_days = KillHistory.DEFAULT_HALF_LIFE / 86400
         self.__executing = False
 
     def on_events(self, flags):
@@ -89,10 +90,72 @@ class Kill(kp.Plugin):
 
         self._hide_background = settings.get_bool("hide_background", "main", False)
         self.dbg("hide_background =", self._hide_background)
+        self._engine.hide_background = self._hide_background
 
         self._item_label = settings.get("item_label", "main", self.DEFAULT_ITEM_LABEL)
         self.dbg("item_label =", self._item_label)
 
+        self._desc_max_length = settings.get_int("desc_max_length", "main", self.DEFAULT_DESC_MAX_LENGTH, min=20)
+        self.dbg("desc_max_length =", self._desc_max_length)
+
+        self._batch_preview_count = settings.get_int("batch_preview_count", "main", self.DEFAULT_BATCH_PREVIEW_COUNT,
+                                                     min=0)
+        self.dbg("batch_preview_count =", self._batch_preview_count)
+
+        self._history_enabled = settings.get_bool("kill_history", "main", True)
+        self.dbg("kill_history =", self._history_enabled)
+
+        self._history_size = settings.get_int("kill_history_size", "main", KillHistory.DEFAULT_MAX_ENTRIES, min=1,
+                                              max=KillHistory.MAX_ENTRIES)
+        self.dbg("kill_history_size =", self._history_size)
+
+        self._history_half_life_days = settings.get_float("kill_history_half_life", "main",
+                                                          KillHistory.DEFAULT_HALF_LIFE / 86400, min=0.01)
+        self.dbg("kill_history_half_life =", self._history_half_life_days)
+
+        # reloaded with the new settings on next use
+        self._history = None
+
+        self._engine.handle_pool_size = settings.get_int("handle_pool_size", "main", HandlePool.DEFAULT_MAX_HANDLES,
+                                                         min=0)
+        self.dbg("handle_pool_size =", self._engine.handle_pool_size)
+
+        self._engine.rules = self._read_rules(settings)
+
+        show_services = settings.get_bool("show_services", "main", True)
+        self.dbg("show_services =", show_services)
+        self._engine.service_backend = win32.ScmServiceBackend() if show_services else None
+
+        metrics_log = settings.get_bool("metrics_log", "main", False)
+        self.dbg("metrics_log =", metrics_log)
+        if metrics_log:
+            max_kb = settings.get_int("metrics_log_max_kb", "main", Metrics.DEFAULT_MAX_BYTES // 1024, min=1)
+            self.dbg("metrics_log_max_kb =", max_kb)
+            backups = settings.get_int("metrics_log_backups", "main", Metrics.DEFAULT_BACKUPS, min=0)
+            self.dbg("metrics_log_backups =", backups)
+            path = os.path.join(self.get_package_cache_path(True), "metrics.jsonl")
+            self._metrics.configure(path, max_kb * 1024, backups)
+        else:
+            self._metrics.configure(None)
+
+    def _read_rules(self, settings):
+        """Reads the include/exclude/protect rules and compiles them
+        """
+        matchers = {}
+        for kind in ("include", "exclude", "protect"):
+            names = settings.get_multiline(kind + "_names", "rules",
+                                           self.DEFAULT_PROTECT_NAMES if kind == "protect" else [])
+            paths = settings.get_multiline(kind + "_paths", "rules", [])
+            sessions = []
+            for session in settings.get_multiline(kind + "_sessions", "rules", []):
+                try:
+                    sessions.append(int(session))
+                except ValueError:
+                    self.warn("Invalid session id in {}_sessions: {}".format(kind, session))
+            self.dbg("{} rules: names={} paths={} sessions={}".format(kind, names, paths, sessions))
+            matchers[kind] = Matcher(names, paths, sessions)
+        return ProcessRules(**matchers)
+
     def on_start(self):
         """Reads the config, creates the actions for killing the processes and register them
         """
@@ -116,7 +179,8 @@ class Kill(kp.Plugin):
             name=self.ACTION_KILL_BY_NAME_ADMIN,
             label="Kill by Name (as Admin)",
             short_desc="Kills all processes by that name"
-            + " with elevated rights (taskkill /F /IM <exe>)"
+            + " with elevated rights (taskkill /F /IM <exe>, or /PID <pid> for each"
+            + " one if protect rules by path or session exist)"
         )
         self._actions.append(kill_by_name_admin)
 
@@ -135,6 +199,15 @@ class Kill(kp.Plugin):
         )
         self._actions.append(copy_image_path)
 
+        if self._debug:
+            dump_snapshot = self.create_action(
+                name=self.ACTION_DUMP_SNAPSHOT,
+                label="Dump process snapshot (debug)",
+                short_desc="Writes the raw process list, window list and icon results to the package's cache directory"
+                + " to replay them later"
+            )
+            self._actions.append(dump_snapshot)
+
         self.set_actions(kp.ItemCategory.KEYWORD, self._actions)
 
         kill_and_restart_by_id = self.create_action(
@@ -155,7 +228,16 @@ class Kill(kp.Plugin):
 
         self.set_actions(RESTARTABLE, self._actions)
 
-        self._default_icon = self.load_icon("res://{}/kill.ico".format(self.package_full_name()))
+        kill_by_pattern = self.create_action(
+            name=self.ACTION_KILL_BY_PATTERN,
+            label="Kill all matching processes",
+            short_desc="Kills all processes of the list that match the pattern"
+        )
+        self.set_actions(BATCH, [kill_by_pattern])
+
+        # protected processes can't be killed, so only the copy actions are offered
+        self.set_actions(PROTECTED, [act for act in self._actions
+                                     if act.name() in (self.ACTION_COPY_IMAGE_PATH, self.ACTION_COPY_CMD_LINE)])
 
     def on_catalog(self):
         """Adds the kill command to the catalog
@@ -172,290 +254,147 @@ class Kill(kp.Plugin):
         catalog.append(killcmd)
         self.set_catalog(catalog)
 
+    def _load_exe_icon(self, source):
+        """Loads the first icon within the source which should be a path to an executable
+        """
+        return self.load_icon("@{},0".format(source))
+
     def _get_icon(self, source):
-        """Tries to load the first icon within the source which should be a path to an executable
+        """Returns the icon of the executable or the default icon
         """
-        if not source:
-            return self._default_icon
+        return self._icons.get(source, self._default_icon)
 
-        if source in self._icons:
-            return self._icons[source]
-        else:
-            try:
-                icon = self.load_icon("@{},0".format(source))
-                self._icons[source] = icon
-            except ValueError:
-                self.dbg("Icon loading failed :(", source)
-                icon = None
-            if not icon:
-                return self._default_icon
-            return icon
+    def _load_default_icon(self):
+        """Loads the package icon, deferred until the process list is shown for the first time
+        """
+        if self._default_icon is None:
+            self._default_icon = self.load_icon("res://{}/kill.ico".format(self.package_full_name()))
 
     def _get_processes(self):
         """Creates the list of running processes, when the Keypirinha Box is triggered
         """
         start_time = time.time()
 
-        wmi = None
-        if com_cl:
-            wmi = com_cl.CoGetObject("winmgmts:")
+        self._load_default_icon()
+        self._engine.process_backend = self._create_process_backend()
+        self._engine.history = self._get_history()
+        self._engine.snapshot_processes()
 
-        if wmi:
-            self._get_processes_from_com_object(wmi)
-        else:
-            self.warn("Windows Management Service is not running.")
-            self._get_processes_from_ext_call()
+        self._icons.load_time = 0.0
+        with self._metrics.span("items"):
+            self._processes = [self._create_process_item(proc) for proc in self._engine.ordered()]
+            self._items_by_pid = {int(item.target().split("|")[1]): item for item in self._processes}
+        # icons are loaded while building the items, so their time is accumulated and reported as one span
+        self._metrics.add_span("icons", self._icons.load_time)
+        self._metrics.count("items_built", len(self._processes))
 
         elapsed = time.time() - start_time
-
         self.info("Found {} running processes in {:0.1f} seconds".format(len(self._processes), elapsed))
         self.dbg(len(self._icons), "icons loaded")
+        if self._debug:
+            report = self._engine.memory_report()
+            self.dbg("Snapshot memory: {total_bytes} bytes for {processes} processes ({bytes_per_process} bytes per"
+                     " process, {object_bytes} bytes objects, {string_bytes} bytes strings)".format(**report))
 
-    def _get_windows(self):
-        """Gets the list of open windows create a mapping between pid and hwnd
+    def _history_path(self):
+        return os.path.join(self.get_package_cache_path(True), "history.json")
+
+    def _get_history(self):
+        """Returns the kill history (loaded on first use) or None if it's disabled
         """
-        self.dbg("Getting windows")
+        if not self._history_enabled:
+            return None
+        if self._history is None:
+            self._history = KillHistory(self._history_size, self._history_half_life_days * 86400)
+            self._history.load(self._history_path())
+            self.dbg(len(self._history), "entries in kill history")
+        return self._history
+
+    def _record_kills(self, names):
+        """Adds a kill of each of the image names to the kill history and saves it
+        """
+        history = self._get_history()
+        if history is None or not names:
+            return
+        for name in names:
+            history.record(name)
         try:
-            handles = AltTab.list_alttab_windows()
+            history.save(self._history_path())
         except OSError:
-            self.err("Failed to list windows.", traceback.format_exc())
-            return
-
-        self._processes_with_window = {}
+            self.warn("Saving kill history failed", traceback.format_exc())
 
-        for hwnd in handles:
-            try:
-                _, proc_id = AltTab.get_window_thread_process_id(hwnd)
-                if proc_id in self._processes_with_window:
-                    self._processes_with_window[proc_id].append(hwnd)
-                else:
-                    self._processes_with_window[proc_id] = [hwnd]
-            except OSError:
-                continue
-        self.dbg(len(self._processes_with_window), "windows found")
-
-    def _get_processes_from_com_object(self, wmi):
-        """Creates the list of running processes
+    def _create_process_backend(self):
+        """Returns the WMI process backend or the wmic fallback if WMI is not available
+        """
+        where = self._engine.rules.wql_condition()
+        self.dbg("WQL condition:", where)
+        backend = win32.WmiProcessBackend.create(self, where)
+        if not backend:
+            self.warn("Windows Management Service is not running.")
+            backend = win32.WmicProcessBackend(self, where)
+        return backend
 
-        Uses Windows Management COMObject (WMI) to get the running processes
+    def _dump_snapshot(self):
+        """Enumerates windows and processes again and writes their raw data together with the icon results to a file
         """
-        result_wmi = wmi.ExecQuery("SELECT ProcessId, Caption, Name, ExecutablePath, CommandLine "
-                                   "FROM Win32_Process")
-        for proc in result_wmi:
-            pid = proc.Properties_["ProcessId"].Value
-            is_foreground = pid in self._processes_with_window
-            if is_foreground:
-                window_title = AltTab.get_window_text(self._processes_with_window[pid][0])
-            else:
-                window_title = ""
-
-            if self._hide_background and not is_foreground:
-                continue
-
-            short_desc = ""
-            category = kp.ItemCategory.KEYWORD
-            databag = {}
-            if proc.Properties_["CommandLine"].Value:
-                short_desc = "(pid: {:>5}) {}".format(
-                    proc.Properties_["ProcessId"].Value,
-                    proc.Properties_["CommandLine"].Value
-                )
-                category = RESTARTABLE
-                databag["CommandLine"] = proc.Properties_["CommandLine"].Value
-            elif proc.Properties_["ExecutablePath"].Value:
-                short_desc = "(pid: {:>5}) {}".format(
-                    proc.Properties_["ProcessId"].Value,
-                    proc.Properties_["ExecutablePath"].Value
-                )
-            elif proc.Properties_["Name"].Value:
-                short_desc = "(pid: {:>5}) {} ({})".format(
-                    proc.Properties_["ProcessId"].Value,
-                    proc.Properties_["Name"].Value,
-                    "Probably only killable as admin or not at all"
-                )
-
-            if proc.Properties_["ExecutablePath"].Value:
-                databag["ExecutablePath"] = proc.Properties_["ExecutablePath"].Value
-
-            if not self._hide_background:
-                if is_foreground:
-                    label = '{}: "{}" ({})'.format(
-                        proc.Properties_["Caption"].Value,
-                        window_title,
-                        'foreground'
-                    )
-                else:
-                    label = '{} ({})'.format(proc.Properties_["Caption"].Value, 'background')
-            else:
-                label = '{}: "{}"'.format(
-                    proc.Properties_["Caption"].Value,
-                    window_title
-                )
-
-            item = self.create_item(
-                category=category,
-                label=label,
-                short_desc=short_desc,
-                target=proc.Properties_["Name"].Value + "|" + str(proc.Properties_["ProcessId"].Value),
-                icon_handle=self._get_icon(proc.Properties_["ExecutablePath"].Value),
-                args_hint=kp.ItemArgsHint.FORBIDDEN,
-                hit_hint=kp.ItemHitHint.IGNORE,
-                data_bag=str(databag)
-            )
-            self._processes.append(item)
+        from .lib import replay
+
+        recording = replay.Recording()
+        engine = ProcessEngine(process_backend=replay.RecordingProcessBackend(self._create_process_backend(),
+                                                                              recording),
+                               window_backend=replay.RecordingWindowBackend(win32.AltTabWindowBackend(), recording),
+                               log=self)
+        if self._engine.service_backend is not None:
+            engine.service_backend = replay.RecordingServiceBackend(self._engine.service_backend, recording)
+        engine.hide_background = self._hide_background
+        engine.snapshot_windows()
+        engine.snapshot_processes()
+        recording.icons = self._icons.results()
+
+        path = os.path.join(self.get_package_cache_path(True),
+                            "snapshot-{}.json.gz".format(time.strftime("%Y%m%d-%H%M%S")))
+        recording.save(path)
+        self.info("Snapshot with {} processes written to {}".format(len(engine.processes), path))
+
+    def _create_process_item(self, proc):
+        """Creates the suggestion item for one process of the snapshot
+
+        The item only carries a shortened description, the full command line and path stay in the engine's snapshot
+        and are looked up by pid when needed.
+        """
+        return self.create_item(
+            category=self._item_category(proc),
+            label=proc.label(self._hide_background),
+            short_desc=proc.short_desc(self._desc_max_length),
+            target=proc.name + "|" + str(proc.pid),
+            icon_handle=self._get_icon(proc.path),
+            args_hint=kp.ItemArgsHint.FORBIDDEN,
+            hit_hint=kp.ItemHitHint.IGNORE
+        )
 
-    def _get_processes_from_ext_call(self):
-        """FALLBACK
+    @staticmethod
+    def _item_category(proc):
+        if proc.protected:
+            return PROTECTED
+        if proc.restartable:
+            return RESTARTABLE
+        return kp.ItemCategory.KEYWORD
 
-        Creates the list of running processes
-        Uses Windows' "wmic.exe" tool to get the running processes
+    def _lookup_item(self, item):
+        """Returns the ProcessInfo for an item from the snapshot or fetches it, if it's not there anymore
         """
-        # Using external call to wmic to get the list of running processes
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        output, err = subprocess.Popen(["wmic",
-                                        "process",
-                                        "get",
-                                        "ProcessId,Caption,",
-                                        "Name,ExecutablePath,CommandLine",
-                                        "/FORMAT:LIST"],
-                                       stdout=subprocess.PIPE,
-                                       # universal_newlines=True,
-                                       shell=False,
-                                       startupinfo=startupinfo).communicate()
-        # log error if any
-        if err:
-            self.err(err)
-
-        # Parsing process list from output
-        outstr = None
-        for enc in ["cp437", "cp850", "cp1252", "utf8"]:
-            try:
-                output = output.replace(b"\r\r", b"\r")
-                outstr = output.decode(enc)
-                break
-            except UnicodeDecodeError:
-                self.dbg(enc, "threw exception")
-
-        if not outstr:
-            self.warn("decoding of output failed")
-            return
+        _, pid = item.target().split("|")
+        proc = self._engine.lookup(int(pid))
+        self.dbg("process for item:", proc)
+        return proc
 
-        info = {}
-        for line in outstr.splitlines():
-            if line.strip() == "":
-                # build catalog item with gathered information from parsing
-                if info and "Caption" in info:
-                    is_foreground = int(info["ProcessId"]) in self._processes_with_window
-                    if self._hide_background and not is_foreground:
-                        continue
-
-                    short_desc = ""
-                    category = kp.ItemCategory.KEYWORD
-                    databag = {}
-                    if "CommandLine" in info and info["CommandLine"] != "":
-                        short_desc = "(pid: {:>5}) {}".format(
-                            info["ProcessId"],
-                            info["CommandLine"]
-                        )
-                        category = RESTARTABLE
-                        databag["CommandLine"] = info["CommandLine"]
-                    elif "ExecutablePath" in info and info["ExecutablePath"] != "":
-                        short_desc = "(pid: {:>5}) {}".format(
-                            info["ProcessId"],
-                            info["ExecutablePath"]
-                        )
-                    elif "Name" in info:
-                        short_desc = "(pid: {:>5}) {}".format(
-                            info["ProcessId"],
-                            info["Name"]
-                        )
-
-                    if "ExecutablePath" in info and info["ExecutablePath"] != "":
-                        databag["ExecutablePath"] = info["ExecutablePath"]
-
-                    label = info["Caption"]
-                    if not self._hide_background:
-                        if is_foreground:
-                            label = "{} (foreground)".format(label)
-                        else:
-                            label = "{} (background)".format(label)
-
-                    item = self.create_item(
-                        category=category,
-                        label=label,
-                        short_desc=short_desc,
-                        target=info["Name"] + "|" + info["ProcessId"],
-                        icon_handle=self._get_icon(info["ExecutablePath"]),
-                        args_hint=kp.ItemArgsHint.FORBIDDEN,
-                        hit_hint=kp.ItemHitHint.IGNORE,
-                        data_bag=str(databag)
-                    )
-                    self._processes.append(item)
-                info = {}
-            else:
-                # Save key=value in info dict
-                line_splitted = line.split("=")
-                label = line_splitted[0]
-                value = "=".join(line_splitted[1:])
-                # Skip system processes that cant be killed
-                if label == "Caption" and value in ("System Idle Process", "System"):
-                    continue
-                info[label] = value
-
-    def _is_running(self, pid):
-        wmi = None
-        if com_cl:
-            wmi = com_cl.CoGetObject("winmgmts:")
-
-        if wmi:
-            return self._is_running_from_com_object(wmi, pid)
-        else:
-            return self._is_running_from_ext_call(pid)
-
-    def _is_running_from_com_object(self, wmi, pid):
-        result_wmi = wmi.ExecQuery("SELECT ProcessId, Caption, Name, ExecutablePath, CommandLine "
-                                   "FROM Win32_Process "
-                                   "WHERE ProcessId = {}".format(pid))
-        running = len(result_wmi) > 0
-        self.dbg("(wmi) process with id ", pid, "running" if running else "not running")
-        return running
-
-    def _is_running_from_ext_call(self, pid):
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        output, err = subprocess.Popen(["wmic",
-                                        "process",
-                                        "where",
-                                        "ProcessId={}".format(pid),
-                                        "get",
-                                        "ProcessId",
-                                        "/FORMAT:LIST"],
-                                       stdout=subprocess.PIPE,
-                                       # universal_newlines=True,
-                                       shell=False,
-                                       startupinfo=startupinfo).communicate()
-        # log error if any
-        if err:
-            self.err(err)
-
-        # Parsing process list from output
-        outstr = None
-        for enc in ["cp437", "cp850", "cp1252", "utf8"]:
-            try:
-                output = output.replace(b"\r\r", b"\r")
-                outstr = output.decode(enc)
-                break
-            except UnicodeDecodeError:
-                self.dbg(enc, "threw exception")
-
-        if not outstr:
-            self.warn("decoding of output failed")
-            return False
-
-        running = "ProcessId={}".format(pid) in outstr.splitlines()
-        self.dbg("(wmic) process with id ", pid, "running" if running else "not running")
-        return running
+    def _get_windows(self):
+        """Gets the list of open windows create a mapping between pid and hwnd
+        """
+        try:
+            self._engine.snapshot_windows()
+        except OSError:
+            self.err("Failed to list windows.", traceback.format_exc())
 
     def on_deactivated(self):
         """Cleans up, when Keypirinha Box is closed
@@ -466,27 +405,19 @@ class Kill(kp.Plugin):
     def _cleanup(self):
         """Empties the process list, window list and frees the icon handles
         """
+        if not self._processes and not self._engine.has_windows:
+            return
+
         self.dbg("Cleaning up")
-        if self._processes:
-            # Discard some icon handles that are not needed anymore
-            icons_to_free = {}
-            for icon, handle in self._icons.items():
-                found = False
-                for process in self._processes:
-                    databag = eval(process.data_bag())
-                    if "ExecutablePath" in databag and icon == databag["ExecutablePath"]:
-                        found = True
-                        break
-                if not found:
-                    icons_to_free[icon] = handle
-
-            self.dbg("Freeing ", len(icons_to_free), "unused icon handles")
-            for icon, handle in icons_to_free.items():
-                del self._icons[icon]
-                handle.free()
-
-        self._processes_with_window = {}
-        self._processes = []
+        with self._metrics.span("cleanup"):
+            if self._processes:
+                # Discard some icon handles that are not needed anymore
+                freed = self._icons.free_unused(self._engine.paths())
+                self.dbg("Freeing ", freed, "unused icon handles")
+            self._engine.clear()
+            self._processes = []
+            self._items_by_pid = {}
+        self._metrics.flush("session")
 
     def on_suggest(self, user_input, items_chain):
         """Sets the list of running processes as suggestions
@@ -494,25 +425,61 @@ class Kill(kp.Plugin):
         if not items_chain:
             return
 
-        if not self._processes_with_window:
-            self._get_windows()
+        if not self._engine.has_windows or not self._processes:
+            with self._metrics.span("open"):
+                if not self._engine.has_windows:
+                    self._get_windows()
 
-        if not self._processes:
-            self._get_processes()
+                if not self._processes:
+                    self._get_processes()
 
+        pattern = ProcessPattern.parse(user_input) if user_input else None
+        if pattern:
+            self._suggest_batch(pattern)
+            return
+
+        # the items are created in the order of the engine, so they can be used without sorting them again
         if user_input:
             self.set_suggestions(self._processes, kp.Match.FUZZY, kp.Sort.SCORE_DESC)
         else:
-            self.set_suggestions(sorted(self._processes, key=lambda p: (p.label().endswith("(background)"), p.label().lower())),
-                                 kp.Match.ANY,
-                                 kp.Sort.NONE)
+            self.set_suggestions(self._processes, kp.Match.ANY, kp.Sort.NONE)
+
+    def _suggest_batch(self, pattern):
+        """Suggests an item that kills everything matching the pattern, followed by the matching processes as preview
+        """
+        matches = self._engine.find_matching(pattern)
+        preview = ", ".join("{} ({})".format(proc.name, proc.pid) for proc in matches[:self._batch_preview_count])
+        if len(matches) > self._batch_preview_count:
+            preview += " and {} more".format(len(matches) - self._batch_preview_count)
+        protected = sum(1 for proc in matches if proc.protected)
+
+        batch_item = self.create_item(
+            category=BATCH,
+            label='Kill all {} processes matching "{}"'.format(len(matches) - protected, pattern.text),
+            short_desc=preview + (" ({} protected ones are skipped)".format(protected) if protected else ""),
+            target=pattern.text,
+            args_hint=kp.ItemArgsHint.FORBIDDEN,
+            hit_hint=kp.ItemHitHint.IGNORE
+        )
+        suggestions = [batch_item] + [self._items_by_pid[proc.pid] for proc in matches
+                                      if proc.pid in self._items_by_pid]
+        self.set_suggestions(suggestions, kp.Match.ANY, kp.Sort.NONE)
 
     def on_execute(self, item, action):
         """Executes the selected (or default) kill action on the selected item
         """
         self.__executing = True
-        loop = None
         try:
+            # protected processes have no kill actions, so there is nothing to do by default
+            if action is None and item.category() == PROTECTED:
+                self.warn("Refusing to kill protected process", item.target())
+                return
+
+            if item.category() == BATCH:
+                with self._metrics.span("kill", action=self.ACTION_KILL_BY_PATTERN):
+                    self._kill_by_pattern(item.target())
+                return
+
             # get default action if no action was explicitly selected
             if action is None:
                 for act in self._actions:
@@ -520,188 +487,136 @@ class Kill(kp.Plugin):
                         action = act
 
             if action.name() == self.ACTION_COPY_CMD_LINE:
-                databag = eval(item.data_bag())
-                self.dbg(databag)
-                if "CommandLine" in databag:
-                    kpu.set_clipboard(databag["CommandLine"])
+                proc = self._lookup_item(item)
+                if proc and proc.cmdline:
+                    kpu.set_clipboard(proc.cmdline)
                 else:
                     self.err("CommandLine could not be obtained")
                 return
             elif action.name() == self.ACTION_COPY_IMAGE_PATH:
-                databag = eval(item.data_bag())
-                self.dbg(databag)
-                if "ExecutablePath" in databag:
-                    kpu.set_clipboard(databag["ExecutablePath"])
+                proc = self._lookup_item(item)
+                if proc and proc.path:
+                    kpu.set_clipboard(proc.path)
                 else:
                     self.err("ExecutablePath could not be obtained")
                 return
+            elif action.name() == self.ACTION_DUMP_SNAPSHOT:
+                self._dump_snapshot()
+                return
 
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            if action.name().endswith(self.ADMIN_SUFFIX):
-                self._kill_process_admin(item, action.name())
-            else:
-                killing_task = asyncio.ensure_future(self._kill_process_normal(item, action.name()))
-                loop.run_until_complete(killing_task)
+            with self._metrics.span("kill", action=action.name()):
+                if action.name().endswith(self.ADMIN_SUFFIX):
+                    self._kill_process_admin(item, action.name())
+                else:
+                    self._kill_process_normal(item, action.name())
         finally:
             self._cleanup()
             self.__executing = False
-            if loop:
-                loop.close()
 
-    async def _kill_process_normal(self, target_item, action_name):
+    def _kill_process_normal(self, target_item, action_name):
         """Kills the selected process(es) using the windows api
         """
         target_name, target_pid = target_item.target().split("|")
         if action_name.startswith(self.ACTION_KILL_BY_NAME):
-            # loop over all processes and kill all by the same name
-            kill_tasks = {}
-            for process_item in self._processes:
-                pname, pid = process_item.target().split("|")
-                pid = int(pid)
-                if pname == target_name:
-                    self.dbg("Killing process with id: {} and name: {}".format(pid, pname))
-                    kill_tasks[pid] = asyncio.get_event_loop().run_in_executor(None, self._kill_by_pid, pid)
-            await asyncio.gather(*kill_tasks.values(), return_exceptions=True)
-
-            self.dbg("Kill tasks finished")
-            for pid, kill_task in kill_tasks.items():
-                exc = kill_task.exception()
-                if exc:
-                    self.err(exc)
-                    self.dbg(traceback.format_exception(exc.__class__, exc, exc.__traceback__))
-                    continue
-                result = kill_task.result()
-                if result:
-                    process = next((p for p in self._processes if int(p.target().split("|")[1]) == pid), None)
-                    if process:
-                        self.dbg("removing from list:", process)
-                        self._processes.remove(process)
-                else:
-                    self.warn("Killing process with pid", pid, "failed")
+            # kill all processes by the same name
+            pids = [proc.pid for proc in self._engine.find_by_name(target_name)]
+            self.dbg("Killing processes with ids: {} and name: {}".format(pids, target_name))
+            if any(self._engine.kill_many(pids).values()):
+                self._record_kills([target_name])
 
         elif action_name.startswith(self.ACTION_KILL_BY_ID):
             # kill process with that pid
             self.dbg("Killing process with id: {} and name: {}".format(target_pid, target_name))
-            pid = int(target_pid)
-            killed = await asyncio.get_event_loop().run_in_executor(None, self._kill_by_pid, pid)
-            if killed:
-                process = next((p for p in self._processes if int(p.target().split("|")[1]) == pid), None)
-                if process:
-                    self.dbg("removing from list:", process)
-                    self._processes.remove(process)
-            else:
-                self.warn("Killing process with id", pid, "failed")
-        elif self.ACTION_KILL_RESTART_BY_ID:
+            if self._engine.kill_many([int(target_pid)])[int(target_pid)]:
+                self._record_kills([target_name])
+
+        elif action_name == self.ACTION_KILL_RESTART_BY_ID:
             # kill process with that pid and try to restart it
             self.dbg("Killing process with id: {} and name: {}".format(target_pid, target_name))
             pid = int(target_pid)
-            killed = await asyncio.get_event_loop().run_in_executor(None,
-                                                                    lambda: self._kill_by_pid(pid, wait_for_exit=True))
+            # looked up before killing, because killing removes it from the snapshot
+            proc = self._lookup_item(target_item)
+            killed = self._engine.kill_many([pid], wait_for_exit=True)[pid]
             if not killed:
                 self.warn("Killing process with id", pid, "failed. Not restarting")
                 return
-            databag = eval(target_item.data_bag())
-            self.dbg("databag for process: ", databag)
-            if "CommandLine" not in databag:
+            if not proc or not proc.cmdline:
                 self.warn("No commandline, cannot restart")
                 return
 
-            cmd = ct.wintypes.LPCWSTR(databag["CommandLine"])
-            argc = ct.c_int(0)
-            argv = CommandLineToArgvW(cmd, ct.byref(argc))
-            if argc.value <= 0:
+            args = win32.split_command_line(proc.cmdline)
+            if not args:
                 self.dbg("No args parsed")
                 return
 
-            args = [argv[i] for i in range(0, argc.value)]
             self.dbg("CommandLine args from CommandLineToArgvW:", args)
             if args[0] == "" or args[0].isspace():
-                args[0] = databag["ExecutablePath"]
+                args[0] = proc.path
             self.dbg("Restarting:", args)
             kpu.shell_execute(args[0], args[1:])
 
-    def _kill_by_pid(self, pid, wait_for_exit=False):
-        proc_handle = KERNEL.OpenProcess(PROCESS_TERMINATE | SYNCHRONIZE, False, pid)
-        if not proc_handle:
-            self.dbg("OpenProcess failed, ErrorCode:", KERNEL.GetLastError())
-            return False
-
-        if pid in self._processes_with_window:
-            self.dbg("Posting WM_CLOSE to", len(self._processes_with_window[pid]), "windows")
-            for hwnd in self._processes_with_window[pid]:
-                success = PostMessageW(hwnd, ct.c_uint(WM_CLOSE), 0, 0)
-                self.dbg("PostMessageW return:", success)
-
-            self.dbg("Waiting for exit")
-            timeout = ct.wintypes.DWORD(5000)
-            result = KERNEL.WaitForSingleObject(proc_handle, timeout)
-            if result == WAIT_OBJECT_0:
-                self.dbg("process exited clean.")
-                return True
-            if result == WAIT_TIMEOUT:
-                self.dbg("WaitForSingleObject timed out.")
-            else:
-                self.warn("Something weird happened in WaitForSingleObject:", result)
-            self.dbg("ErrorCode:", KERNEL.GetLastError())
-            if not self._is_running(pid):
-                return True
-
-        self.dbg("Calling ExitProcess in Remote Thread")
-        thread = KERNEL.CreateRemoteThread(proc_handle, None, 0, KERNEL.ExitProcess, ct.c_uint(1), 0)
-        if thread:
-            self.dbg("Waiting for exit")
-            timeout = ct.wintypes.DWORD(5000)
-            result = KERNEL.WaitForSingleObject(proc_handle, timeout)
-            if result == WAIT_OBJECT_0:
-                self.dbg("process exited clean.")
-                return True
-            if result == WAIT_TIMEOUT:
-                self.dbg("WaitForSingleObject timed out.")
-            else:
-                self.warn(
-                    "Something weird happened in WaitForSingleObject:", result)
-            self.dbg("ErrorCode:", KERNEL.GetLastError())
-            if not self._is_running(pid):
-                return True
-
-        self.dbg("TerminateProcess!")
-        success = KERNEL.TerminateProcess(proc_handle, 1)
-        if not success:
-            self.warn("TerminateProcess failed, ErrorCode:", KERNEL.GetLastError())
-            return False
-
-        if wait_for_exit:
-            self.dbg("Waiting for exit")
-            timeout = ct.wintypes.DWORD(1000)
-            result = KERNEL.WaitForSingleObject(proc_handle, timeout)
-            if result == WAIT_FAILED:
-                self.warn("WaitForSingleObject failed, ErrorCode:", KERNEL.GetLastError())
-                return False
-            if result == WAIT_TIMEOUT:
-                self.warn("WaitForSingleObject timed out.")
-                return False
-            if result != WAIT_OBJECT_0:
-                self.warn("Something weird happened in WaitForSingleObject:", result)
-                return False
-
-        return True
+    def _kill_by_pattern(self, text):
+        """Kills all processes of the snapshot matching the pattern concurrently and logs a summary
+        """
+        pattern = ProcessPattern.parse(text)
+        if not pattern:
+            self.err("Not a valid pattern:", text)
+            return
+
+        start_time = time.time()
+        matches = [proc for proc in self._engine.find_matching(pattern) if not proc.protected]
+        names = {proc.pid: proc.name for proc in matches}
+        self.dbg("Killing {} processes matching {}".format(len(matches), text))
+        results = self._engine.kill_many([proc.pid for proc in matches])
+        elapsed = time.time() - start_time
+
+        for pid, killed in sorted(results.items()):
+            self.info("  {} (pid: {}) {}".format(names[pid], pid, "killed" if killed else "FAILED"))
+        killed = sum(1 for result in results.values() if result)
+        self.info('Killed {} of {} processes matching "{}" in {:0.1f} seconds'.format(killed, len(results), text,
+                                                                                     elapsed))
+
+        self._record_kills({names[pid] for pid, result in results.items() if result})
 
     def _kill_process_admin(self, target_item, action_name):
         """Kills the selected process(es) using a call to windows' taskkill.exe  with elevated rights
         """
         target_name, target_pid = target_item.target().split("|")
+        proc = self._lookup_item(target_item)
+        if self._engine.rules.protected(target_name, proc.path if proc else None, proc.session if proc else None):
+            self.warn("Refusing to kill protected process", target_name)
+            return
+
         args = ["taskkill", "/F"]
 
         # add parameters according to action
         if action_name.startswith(self.ACTION_KILL_BY_NAME):
-            args.append("/IM")
-            # process name
-            args.append(target_name)
+            protect = self._engine.rules.protect
+            if protect.paths or protect.sessions:
+                # a protected name was refused above, but /IM would also hit processes of that name protected by
+                # session or path, so only the unprotected ones of the snapshot are named explicitly
+                matches = self._engine.find_by_name(target_name)
+                skipped = [proc.pid for proc in matches if proc.protected]
+                if skipped:
+                    self.warn("Not killing protected processes with ids", skipped, "and name", target_name)
+                pids = [str(proc.pid) for proc in matches if not proc.protected]
+                if not pids:
+                    self.warn("Refusing to kill protected process", target_name)
+                    return
+                for pid in pids:
+                    args.extend(["/PID", pid])
+            else:
+                args.append("/IM")
+                # process name
+                args.append(target_name)
         elif action_name.startswith(self.ACTION_KILL_BY_ID):
             args.append("/PID")
             # process id
             args.append(target_pid)
 
+        import subprocess
+
         self.dbg("Calling:", args)
         kpu.shell_execute(args[0], args[1:], verb="runas", show=subprocess.SW_HIDE)
+        # taskkill runs detached, so its result is unknown and the kill is counted anyway
+        self._record_kills([target_name])
@@ -0,0 +1,629 @@
+import fnmatch
+import heapq
+import re
+import sys
+import time
+import traceback
+
+from .handles import HandlePool, cim_to_filetime
+from .metrics import Metrics
+from .rules import ProcessRules
+
+WAIT_OBJECT_0 = 0x00000000
+WAIT_TIMEOUT = 0x00000102
+WAIT_FAILED = 0xFFFFFFFF
+
+CLOSE_TIMEOUT_MS = 5000
+EXIT_TIMEOUT_MS = 5000
+TERMINATE_TIMEOUT_MS = 1000
+
+# Columns every process backend delivers for each row, ProcessId and SessionId as int, everything else as str or None
+# (CreationDate as WMI CIM_DATETIME string)
+PROCESS_COLUMNS = ("ProcessId", "Caption", "Name", "ExecutablePath", "CommandLine", "SessionId", "CreationDate")
+
+
+def truncate(text, max_length):
+    """Shortens text to max_length characters, marking the cut with "..."
+    """
+    if max_length is None or len(text) <= max_length:
+        return text
+    return text[:max(max_length - 3, 0)] + "..."
+
+
+class NullLog:
+    """Logger that swallows everything, used when the engine runs without a plugin
+    """
+    def dbg(self, *args):
+        pass
+
+    def info(self, *args):
+        pass
+
+    def warn(self, *args):
+        pass
+
+    def err(self, *args):
+        pass
+
+
+def parse_wmic_list(outstr):
+    """Parses the output of "wmic process get ... /FORMAT:LIST" into process rows
+
+    Blocks of key=value lines are separated by empty lines. System processes that can't be killed are skipped.
+    """
+    rows = []
+    info = {}
+    for line in outstr.splitlines():
+        if line.strip() == "":
+            if info and "Caption" in info:
+                rows.append({
+                    "ProcessId": int(info["ProcessId"]),
+                    "Caption": info["Caption"],
+                    "Name": info.get("Name") or info["Caption"],
+                    "ExecutablePath": info.get("ExecutablePath") or None,
+                    "CommandLine": info.get("CommandLine") or None,
+                    "SessionId": int(info["SessionId"]) if info.get("SessionId") else None,
+                    "CreationDate": info.get("CreationDate") or None,
+                })
+            info = {}
+        else:
+            # Save key=value in info dict
+            label, _, value = line.partition("=")
+            # Skip system processes that cant be killed
+            if label == "Caption" and value in ("System Idle Process", "System"):
+                continue
+            info[label] = value
+    return rows
+
+
+class ProcessInfo:
+    """One entry of a process snapshot
+    """
+    __slots__ = ("pid", "name", "caption", "path", "cmdline", "session", "foreground", "window_title", "protected",
+                 "services")
+
+    def __init__(self, pid, name, caption, path, cmdline, session, foreground, window_title, protected=False,
+                 services=()):
+        self.pid = pid
+        self.name = name
+        self.caption = caption
+        self.path = path
+        self.cmdline = cmdline
+        self.session = session
+        self.foreground = foreground
+        self.window_title = window_title
+        self.protected = protected
+        self.services = services
+
+    def __repr__(self):
+        return "ProcessInfo(pid={}, name={!r})".format(self.pid, self.name)
+
+    @property
+    def restartable(self):
+        return bool(self.cmdline)
+
+    @property
+    def display_name(self):
+        """The caption followed by the names of the services hosted in the process, if there are any
+        """
+        if self.services:
+            return "{} [{}]".format(self.caption, ", ".join(self.services))
+        return self.caption
+
+    def label(self, hide_background=False):
+        """Text that is shown and matched against the user input
+        """
+        if hide_background:
+            return '{}: "{}"'.format(self.display_name, self.window_title)
+        if self.foreground:
+            return '{}: "{}" ({})'.format(self.display_name, self.window_title, "foreground")
+        return "{} ({})".format(self.display_name, "background")
+
+    def short_desc(self, max_length=None):
+        """Secondary text with the pid and the command line or path of the process, cut to max_length characters
+        """
+        if self.cmdline:
+            return "(pid: {:>5}) {}".format(self.pid, truncate(self.cmdline, max_length))
+        if self.path:
+            return "(pid: {:>5}) {}".format(self.pid, truncate(self.path, max_length))
+        if self.name:
+            return "(pid: {:>5}) {} ({})".format(self.pid, self.name, "Probably only killable as admin or not at all")
+        return ""
+
+
+class ProcessPattern:
+    """Pattern over image name, executable path and command line for batch kills
+
+    The text consists of one or more terms which all have to match:
+      * name:<glob>          - image name, e.g. name:java.exe or name:python*
+      * path:<prefix|glob>   - executable path, a prefix unless it contains wildcards, e.g. path:C:\\build\\
+      * cmd:<text>           - part of the command line, e.g. cmd:gradle
+    Everything is case insensitive, values may contain spaces.
+    """
+    FIELDS = ("name", "path", "cmd")
+    _TERM_SPLIT = re.compile(r"\s+(?=(?:name|path|cmd):)", re.IGNORECASE)
+
+    def __init__(self, text, terms):
+        self.text = text
+        self._terms = terms
+
+    @classmethod
+    def parse(cls, text):
+        """Returns the pattern for text or None if text isn't a pattern
+        """
+        text = text.strip()
+        terms = []
+        for part in cls._TERM_SPLIT.split(text):
+            field, sep, value = part.partition(":")
+            field = field.lower()
+            value = value.strip()
+            if not sep or field not in cls.FIELDS or not value:
+                return None
+            terms.append(cls._compile_term(field, value.lower()))
+        return cls(text, terms) if terms else None
+
+    @staticmethod
+    def _compile_term(field, value):
+        if field == "name":
+            name_re = re.compile(fnmatch.translate(value), re.IGNORECASE)
+            return lambda proc: bool(proc.name) and name_re.match(proc.name) is not None
+        if field == "path":
+            if any(char in value for char in "*?["):
+                path_re = re.compile(fnmatch.translate(value), re.IGNORECASE)
+                return lambda proc: bool(proc.path) and path_re.match(proc.path) is not None
+            return lambda proc: bool(proc.path) and proc.path.lower().startswith(value)
+        return lambda proc: bool(proc.cmdline) and value in proc.cmdline.lower()
+
+    def matches(self, proc):
+        return all(term(proc) for term in self._terms)
+
+
+class IconCache:
+    """Caches icon handles per executable path and frees the ones that are not needed anymore
+
+    The loader gets a path and returns a handle with a free() method or raises ValueError.
+    """
+    def __init__(self, loader, metrics=None, log=None):
+        self._loader = loader
+        self._metrics = metrics or Metrics()
+        self._log = log or NullLog()
+        self._icons = {}
+        self.load_time = 0.0
+
+    def __len__(self):
+        return len(self._icons)
+
+    def get(self, path, default=None):
+        """Returns the icon for path, loading it on the first request
+        """
+        if not path:
+            return default
+
+        if path in self._icons:
+            self._metrics.count("icon_cache_hits")
+            return self._icons[path] or default
+
+        start_time = time.perf_counter()
+        try:
+            icon = self._loader(path)
+            self._metrics.count("icons_loaded")
+        except ValueError:
+            self._log.dbg("Icon loading failed :(", path)
+            self._metrics.count("icon_load_failures")
+            icon = None
+        self._icons[path] = icon
+        self.load_time += time.perf_counter() - start_time
+        return icon or default
+
+    def results(self):
+        """Returns for every requested path whether its icon could be loaded
+        """
+        return {path: icon is not None for path, icon in self._icons.items()}
+
+    def free_unused(self, used_paths):
+        """Frees every icon handle whose path is not in used_paths and returns their count
+        """
+        unused = [path for path in self._icons if path not in used_paths]
+        for path in unused:
+            icon = self._icons.pop(path)
+            if icon:
+                icon.free()
+        self._metrics.count("icons_freed", len(unused))
+        return len(unused)
+
+
+class ProcessEngine:
+    """Snapshots, indexes, orders and kills processes without depending on Keypirinha or the Windows API
+
+    The operating system is reached only through the injected backends:
+      * process_backend: list_processes() -> rows with PROCESS_COLUMNS, get_process(pid) -> row or None,
+        is_running(pid) -> bool
+      * window_backend: list_windows() -> [(hwnd, pid)], window_text(hwnd) -> str
+      * service_backend (optional): list_services() -> [(pid, service name)] of all running services
+      * kill_backend: open(pid, query=False), close(handle), post_close(hwnd), wait(handle, timeout_ms),
+        remote_exit(handle), terminate(handle), creation_time(handle) -> FILETIME value or None (needs a handle
+        opened with query=True)
+    """
+    def __init__(self, process_backend=None, window_backend=None, kill_backend=None, metrics=None, log=None,
+                 service_backend=None):
+        """Constructor, the process backend may also be set right before taking a snapshot
+        """
+        self.process_backend = process_backend
+        self.window_backend = window_backend
+        self.kill_backend = kill_backend
+        self.service_backend = service_backend
+        self.metrics = metrics or Metrics()
+        self.log = log or NullLog()
+        self.hide_background = False
+        self.max_workers = 8
+        # compiled include/exclude/protect rules, applied before anything else is done with a row
+        self.rules = ProcessRules()
+        # optional KillHistory, its scores move often killed processes to the top
+        self.history = None
+        # number of handles that are opened ahead of time for the most likely kill targets, 0 disables the pool
+        self.handle_pool_size = HandlePool.DEFAULT_MAX_HANDLES
+        self._pool = None
+        self.clear()
+
+    def clear(self):
+        """Forgets the current snapshot and closes the pooled handles
+        """
+        if self._pool is not None:
+            self._pool.close_all()
+        self.windows = {}
+        self.services = {}
+        self.processes = []
+        self._by_pid = {}
+        self._by_name = {}
+        self._ordered = None
+
+    @property
+    def has_windows(self):
+        return bool(self.windows)
+
+    @property
+    def has_snapshot(self):
+        return bool(self.processes)
+
+    def get(self, pid):
+        """Returns the ProcessInfo with that pid from the snapshot or None
+        """
+        return self._by_pid.get(pid)
+
+    def lookup(self, pid):
+        """Returns the ProcessInfo with that pid from the snapshot or asks the process backend if it's not in there
+        """
+        proc = self._by_pid.get(pid)
+        if proc is not None:
+            return proc
+
+        row = self.process_backend.get_process(pid) if self.process_backend else None
+        if row is None:
+            return None
+        return self._create_info(row, pid in self.windows, "", self.rules, self.services.get(pid, ()))
+
+    def snapshot_windows(self):
+        """Gets the list of open windows and creates a mapping between pid and hwnds
+        """
+        self.log.dbg("Getting windows")
+        with self.metrics.span("windows"):
+            handles = self.window_backend.list_windows()
+
+        windows = {}
+        for hwnd, pid in handles:
+            if pid in windows:
+                windows[pid].append(hwnd)
+            else:
+                windows[pid] = [hwnd]
+        self.windows = windows
+        self.log.dbg(len(self.windows), "windows found")
+
+    def snapshot_processes(self):
+        """Gets the running processes from the process backend and builds the snapshot and its indexes
+        """
+        with self.metrics.span("processes", source=getattr(self.process_backend, "source", None)):
+            rows = self.process_backend.list_processes()
+        self.snapshot_services()
+        self.build(rows)
+        self.refresh_handles(rows)
+
+    def refresh_handles(self, rows):
+        """Opens handles ahead of time for the most likely kill targets: processes that were killed before and
+        processes with windows, in the order of ordered() but without sorting the whole snapshot
+
+        Every handle is checked against the creation time of its row, so it never belongs to a process that reused
+        the pid. Does nothing without a kill backend or if the pool is disabled.
+        """
+        enabled = self.kill_backend is not None and self.handle_pool_size > 0
+        if self._pool is not None and (not enabled or self._pool.kill_backend is not self.kill_backend):
+            self._pool.close_all()
+            self._pool = None
+        if not enabled:
+            return
+        if self._pool is None:
+            self._pool = HandlePool(self.kill_backend, log=self.log)
+        self._pool.max_handles = self.handle_pool_size
+
+        with self.metrics.span("handles"):
+            scores = self.history.scores() if self.history else {}
+            likely = [proc for proc in self.processes
+                      if proc.foreground or (proc.name and scores.get(proc.name.lower(), 0.0) > 0.0)]
+            likely = heapq.nsmallest(self.handle_pool_size, likely, key=self._order_key(scores))
+            pids = {proc.pid for proc in likely}
+            created = {row["ProcessId"]: row.get("CreationDate") for row in rows if row["ProcessId"] in pids}
+            opened = self._pool.refresh((proc.pid, cim_to_filetime(created.get(proc.pid))) for proc in likely)
+        self.metrics.count("handles_opened", opened)
+        self.log.dbg(len(self._pool), "process handles pooled,", opened, "opened")
+
+    def snapshot_services(self):
+        """Gets the services of all processes in one go from the service backend, they live as long as the snapshot
+        """
+        self.services = {}
+        if self.service_backend is None:
+            return
+
+        with self.metrics.span("services"):
+            try:
+                services = self.service_backend.list_services()
+            except OSError:
+                self.log.warn("Getting the services failed", traceback.format_exc())
+                return
+
+        by_pid = {}
+        for pid, service in services:
+            if not pid:
+                continue
+            if pid in by_pid:
+                by_pid[pid].append(sys.intern(service))
+            else:
+                by_pid[pid] = [sys.intern(service)]
+        self.services = {pid: tuple(sorted(names, key=str.lower)) for pid, names in by_pid.items()}
+        self.log.dbg(len(services), "services in", len(self.services), "processes found")
+
+    def build(self, rows):
+        """Builds the snapshot from process rows
+        """
+        rules = self.rules if self.rules else None
+        with self.metrics.span("index"):
+            processes = []
+            for row in rows:
+                if rules is not None and rules.excluded(row["Name"], row["ExecutablePath"], row.get("SessionId")):
+                    continue
+
+                pid = row["ProcessId"]
+                foreground = pid in self.windows
+                if self.hide_background and not foreground:
+                    continue
+
+                window_title = ""
+                if foreground:
+                    try:
+                        window_title = self.window_backend.window_text(self.windows[pid][0])
+                    except OSError:
+                        self.log.dbg("Getting the window title failed for pid", pid)
+
+                processes.append(self._create_info(row, foreground, window_title, rules, self.services.get(pid, ())))
+            self._set_processes(processes)
+
+    @staticmethod
+    def _create_info(row, foreground, window_title, rules, services):
+        """Creates the ProcessInfo for a row, names and paths are interned because most of them repeat a lot
+        """
+        name = row["Name"]
+        caption = row["Caption"]
+        path = row["ExecutablePath"]
+        session = row.get("SessionId")
+        return ProcessInfo(row["ProcessId"],
+                           sys.intern(name) if name else name,
+                           sys.intern(caption) if caption else caption,
+                           sys.intern(path) if path else path,
+                           row["CommandLine"],
+                           session,
+                           foreground,
+                           window_title,
+                           bool(rules) and rules.protected(name, path, session),
+                           services)
+
+    def memory_report(self):
+        """Estimates the memory held by the snapshot, every distinct object is counted once
+
+        Returns a dict with the number of processes, the bytes of the ProcessInfo objects, the bytes of the strings,
+        the total and the average bytes per process.
+        """
+        seen = set()
+        object_bytes = sys.getsizeof(self.processes)
+        string_bytes = 0
+        for proc in self.processes:
+            object_bytes += sys.getsizeof(proc)
+            if proc.services and id(proc.services) not in seen:
+                seen.add(id(proc.services))
+                object_bytes += sys.getsizeof(proc.services)
+            for value in (proc.name, proc.caption, proc.path, proc.cmdline, proc.window_title) + proc.services:
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    string_bytes += sys.getsizeof(value)
+        total = object_bytes + string_bytes
+        return {
+            "processes": len(self.processes),
+            "object_bytes": object_bytes,
+            "string_bytes": string_bytes,
+            "total_bytes": total,
+            "bytes_per_process": total // len(self.processes) if self.processes else 0,
+        }
+
+    def _set_processes(self, processes):
+        self.processes = processes
+        self._by_pid = {proc.pid: proc for proc in processes}
+        self._by_name = {}
+        for proc in processes:
+            if proc.name in self._by_name:
+                self._by_name[proc.name].append(proc)
+            else:
+                self._by_name[proc.name] = [proc]
+        self._ordered = None
+
+    def ordered(self):
+        """Returns the snapshot in the order for empty input
+
+        Processes that were killed often and recently come first (if there is a history), then foreground processes
+        and then everything alphabetical. The order is computed once per snapshot.
+        """
+        if self._ordered is None:
+            with self.metrics.span("sort"):
+                scores = self.history.scores() if self.history else {}
+                self._ordered = sorted(self.processes, key=self._order_key(scores))
+        return self._ordered
+
+    def _order_key(self, scores):
+        """Returns the sort key function of ordered() for the given history scores
+        """
+        hide_background = self.hide_background
+        if scores:
+            def key(p):
+                return (-scores.get(p.name.lower(), 0.0) if p.name else 0.0,
+                        not p.foreground,
+                        p.label(hide_background).lower())
+        else:
+            def key(p):
+                return not p.foreground, p.label(hide_background).lower()
+        return key
+
+    def find_by_name(self, name):
+        """Returns all processes of the snapshot with exactly that image name
+        """
+        return list(self._by_name.get(name, ()))
+
+    def filter(self, predicate):
+        """Returns all processes of the snapshot for which predicate returns true
+        """
+        return [proc for proc in self.processes if predicate(proc)]
+
+    def find_matching(self, pattern):
+        """Returns all processes of the snapshot that match the ProcessPattern, in the order of ordered()
+        """
+        return [proc for proc in self.ordered() if pattern.matches(proc)]
+
+    def paths(self):
+        """Returns the set of executable paths in the snapshot
+        """
+        return {proc.path for proc in self.processes if proc.path}
+
+    def remove(self, pids):
+        """Removes the processes with the given pids from the snapshot in one go
+        """
+        pids = set(pids)
+        if not pids:
+            return
+        self._set_processes([proc for proc in self.processes if proc.pid not in pids])
+
+    def is_running(self, pid):
+        return self.process_backend.is_running(pid)
+
+    def kill_many(self, pids, wait_for_exit=False):
+        """Kills the processes concurrently and removes the killed ones from the snapshot
+
+        Returns a dict pid -> True/False, exceptions are logged and count as failure.
+        """
+        results = {}
+        allowed = []
+        for pid in pids:
+            proc = self.lookup(pid)
+            if proc is not None and proc.protected:
+                self.log.warn("Refusing to kill protected process", proc.name, "with pid", pid)
+                results[pid] = False
+            else:
+                allowed.append(pid)
+        pids = allowed
+        if not pids:
+            return results
+
+        # concurrent.futures pulls in logging, so it is only imported when something actually gets killed
+        import concurrent.futures
+
+        workers = min(self.max_workers, len(pids))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {pid: executor.submit(self.kill, pid, wait_for_exit) for pid in pids}
+            concurrent.futures.wait(futures.values())
+
+        self.log.dbg("Kill tasks finished")
+        for pid, future in futures.items():
+            exc = future.exception()
+            if exc:
+                self.log.err(exc)
+                self.log.dbg(traceback.format_exception(exc.__class__, exc, exc.__traceback__))
+                results[pid] = False
+                continue
+            results[pid] = future.result()
+            if not results[pid]:
+                self.log.warn("Killing process with pid", pid, "failed")
+
+        self.remove(pid for pid, killed in results.items() if killed)
+        return results
+
+    def kill(self, pid, wait_for_exit=False):
+        """Kills one process by escalating from closing its windows over ExitProcess to TerminateProcess
+        """
+        backend = self.kill_backend
+        handle = self._pool.take(pid) if self._pool is not None else None
+        # a pooled handle belongs to the process of the snapshot for sure, its wait results need no double check
+        pooled = handle is not None
+        if pooled:
+            self.metrics.count("kill.pooled_handle")
+        else:
+            with self.metrics.span("kill.open", pid=pid):
+                handle = backend.open(pid)
+            if not handle:
+                return False
+
+        try:
+            if pid in self.windows:
+                with self.metrics.span("kill.close_windows", pid=pid):
+                    self.log.dbg("Posting WM_CLOSE to", len(self.windows[pid]), "windows")
+                    for hwnd in self.windows[pid]:
+                        backend.post_close(hwnd)
+                    if self._wait_for_exit(handle, pid, CLOSE_TIMEOUT_MS, pooled):
+                        return True
+
+            with self.metrics.span("kill.remote_exit", pid=pid):
+                self.log.dbg("Calling ExitProcess in Remote Thread")
+                if backend.remote_exit(handle) and self._wait_for_exit(handle, pid, EXIT_TIMEOUT_MS, pooled):
+                    return True
+
+            with self.metrics.span("kill.terminate", pid=pid):
+                self.log.dbg("TerminateProcess!")
+                if not backend.terminate(handle):
+                    return False
+
+                if wait_for_exit:
+                    self.log.dbg("Waiting for exit")
+                    result = backend.wait(handle, TERMINATE_TIMEOUT_MS)
+                    if result == WAIT_FAILED:
+                        self.log.warn("WaitForSingleObject failed")
+                        return False
+                    if result == WAIT_TIMEOUT:
+                        self.log.warn("WaitForSingleObject timed out.")
+                        return False
+                    if result != WAIT_OBJECT_0:
+                        self.log.warn("Something weird happened in WaitForSingleObject:", result)
+                        return False
+            return True
+        finally:
+            backend.close(handle)
+
+    def _wait_for_exit(self, handle, pid, timeout_ms, pooled=False):
+        """Waits for the process to exit and double checks with the process backend if the wait didn't succeed
+
+        The double check is skipped for pooled handles, the wait on them is reliable.
+        """
+        self.log.dbg("Waiting for exit")
+        result = self.kill_backend.wait(handle, timeout_ms)
+        if result == WAIT_OBJECT_0:
+            self.log.dbg("process exited clean.")
+            return True
+        if result == WAIT_TIMEOUT:
+            self.log.dbg("WaitForSingleObject timed out.")
+        else:
+            self.log.warn("Something weird happened in WaitForSingleObject:", result)
+        if pooled:
+            return False
+        return not self.is_running(pid)
@@ -0,0 +1,109 @@
+import collections
+import threading
+
+# 100ns intervals between 1601-01-01 (FILETIME) and 1970-01-01
+_EPOCH_AS_FILETIME = 116444736000000000
+# WMI only has microseconds, so creation times are compared with that precision
+_CREATION_TOLERANCE = 10
+
+
+def cim_to_filetime(value):
+    """Converts a WMI CIM_DATETIME like "20261018120000.123456+120" (local time and UTC offset in minutes) into a
+    FILETIME value (100ns intervals since 1601-01-01 UTC), returns None if value is empty or malformed
+    """
+    import calendar
+
+    if not value or len(value) < 25:
+        return None
+    try:
+        seconds = calendar.timegm((int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                                   int(value[8:10]), int(value[10:12]), int(value[12:14]), 0, 0, 0))
+        micros = int(value[15:21])
+        offset = int(value[21:25])
+    except ValueError:
+        return None
+    return (seconds - offset * 60) * 10000000 + micros * 10 + _EPOCH_AS_FILETIME
+
+
+class HandlePool:
+    """Bounded pool of process handles that were opened ahead of time, so killing starts without OpenProcess
+
+    Every handle was checked against the creation time of the process in the snapshot when it was opened. A handle
+    keeps its process object alive, so a pooled handle always refers to the process of the snapshot, even if the pid
+    got reused in the meantime. Handles of processes that drop out of the most likely targets are closed on the next
+    refresh.
+    """
+    DEFAULT_MAX_HANDLES = 32
+
+    def __init__(self, kill_backend, max_handles=DEFAULT_MAX_HANDLES, log=None):
+        self.kill_backend = kill_backend
+        self.max_handles = max(max_handles, 0)
+        self.log = log
+        # pid -> (handle, creation time) in the order of the candidates
+        self._handles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, pid):
+        return pid in self._handles
+
+    def refresh(self, candidates):
+        """Makes sure the pool holds handles for the first max_handles of candidates, an iterable of
+        (pid, creation time) ordered from the most to the least likely kill target
+
+        Handles of processes that are no candidate anymore are closed, handles that still belong to a candidate are
+        kept and new ones are only pooled if the creation time of the process matches. Returns the number of handles
+        that were opened.
+        """
+        wanted = collections.OrderedDict()
+        for pid, created in candidates:
+            if len(wanted) >= self.max_handles:
+                break
+            if created is not None:
+                wanted[pid] = created
+
+        backend = self.kill_backend
+        opened = 0
+        with self._lock:
+            for pid in list(self._handles):
+                handle, created = self._handles[pid]
+                if pid not in wanted or abs(wanted[pid] - created) >= _CREATION_TOLERANCE:
+                    # no likely target anymore or the pid was reused since the handle was opened
+                    del self._handles[pid]
+                    backend.close(handle)
+
+            for pid, created in wanted.items():
+                if pid in self._handles:
+                    self._handles.move_to_end(pid)
+                    continue
+                handle = backend.open(pid, query=True)
+                if not handle:
+                    continue
+                actual = backend.creation_time(handle)
+                if actual is None or abs(actual - created) >= _CREATION_TOLERANCE:
+                    # the process of the snapshot is already gone and something else got its pid
+                    if self.log:
+                        self.log.dbg("Not pooling the handle of pid", pid, "it belongs to a newer process")
+                    backend.close(handle)
+                    continue
+                self._handles[pid] = (handle, created)
+                opened += 1
+        return opened
+
+    def take(self, pid):
+        """Removes the handle of pid from the pool and returns it or None, the caller has to close it
+        """
+        with self._lock:
+            pooled = self._handles.pop(pid, None)
+        return pooled[0] if pooled is not None else None
+
+    def close_all(self):
+        """Closes all handles of the pool
+        """
+        with self._lock:
+            handles = [handle for handle, _ in self._handles.values()]
+            self._handles.clear()
+        for handle in handles:
+            self.kill_backend.close(handle)
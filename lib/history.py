@@ -0,0 +1,102 @@
+import os
+import time
+
+
+class KillHistory:
+    """Decaying frequency/recency ("frecency") score per image name of the processes that were killed
+
+    Every kill adds 1 to the score of the image name, and scores halve every half_life seconds. Scores below
+    MIN_SCORE count as 0 and their names are forgotten. Only max_entries (at most MAX_ENTRIES) names are kept, the one
+    with the lowest score is dropped when a new one doesn't fit anymore.
+    """
+    DEFAULT_MAX_ENTRIES = 50
+    MAX_ENTRIES = 500
+    DEFAULT_HALF_LIFE = 7 * 24 * 60 * 60
+    # a single kill falls below this after a bit more than 4 half lives
+    MIN_SCORE = 0.05
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, half_life=DEFAULT_HALF_LIFE):
+        self.max_entries = min(max(max_entries, 1), self.MAX_ENTRIES)
+        self.half_life = max(half_life, 1)
+        # name -> [score, timestamp of the score]
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(name):
+        # image names are case insensitive on windows
+        return name.lower()
+
+    def _decayed(self, entry, now):
+        score, stamp = entry
+        return score * 0.5 ** (max(now - stamp, 0) / self.half_life)
+
+    def record(self, name, now=None):
+        """Counts one kill of the image name
+        """
+        if not name:
+            return
+        now = time.time() if now is None else now
+        key = self._key(name)
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[0] = self._decayed(entry, now) + 1
+            entry[1] = now
+            return
+
+        if len(self._entries) >= self.max_entries:
+            # scans the table, at most MAX_ENTRIES names and only when a new name doesn't fit anymore
+            scores = {k: self._decayed(entry, now) for k, entry in self._entries.items()}
+            stale = [k for k, score in scores.items() if score < self.MIN_SCORE]
+            for k in stale or [min(scores, key=scores.get)]:
+                del self._entries[k]
+        self._entries[key] = [1.0, now]
+
+    def score(self, name, now=None):
+        """Returns the current score of the image name, 0 if it was never killed or too long ago
+        """
+        entry = self._entries.get(self._key(name))
+        if entry is None:
+            return 0.0
+        score = self._decayed(entry, time.time() if now is None else now)
+        return score if score >= self.MIN_SCORE else 0.0
+
+    def scores(self, now=None):
+        """Returns the current scores of all image names as dict with lower case names as keys, names whose score fell
+        below MIN_SCORE are left out
+        """
+        now = time.time() if now is None else now
+        scores = {key: self._decayed(entry, now) for key, entry in self._entries.items()}
+        return {key: score for key, score in scores.items() if score >= self.MIN_SCORE}
+
+    def load(self, path):
+        """Reads the history from path, a missing or broken file leaves the history empty
+        """
+        import json
+
+        self._entries = {}
+        try:
+            with open(path, encoding="utf-8") as history_file:
+                data = json.load(history_file)
+            entries = {str(key): [float(score), float(stamp)] for key, (score, stamp) in data["entries"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+
+        # keep the best ones, if max_entries was lowered in the meantime, and forget the stale ones
+        now = time.time()
+        entries = {key: entry for key, entry in entries.items() if self._decayed(entry, now) >= self.MIN_SCORE}
+        best = sorted(entries, key=lambda k: self._decayed(entries[k], now), reverse=True)[:self.max_entries]
+        self._entries = {key: entries[key] for key in best}
+        return True
+
+    def save(self, path):
+        """Writes the history to path, replacing the old file in one step
+        """
+        import json
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as history_file:
+            json.dump({"version": 1, "entries": self._entries}, history_file, separators=(",", ":"))
+        os.replace(tmp_path, path)
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+
+
+class _Span:
+    """Context manager that measures the wall time of one phase and reports it back to its Metrics object
+    """
+    __slots__ = ("_metrics", "_name", "_attrs", "_start")
+
+    def __init__(self, metrics, name, attrs):
+        self._metrics = metrics
+        self._name = name
+        self._attrs = attrs
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        elapsed = time.perf_counter() - self._start
+        self._metrics.add_span(self._name, elapsed, error=exc_type is not None, **self._attrs)
+        return False
+
+
+class _NullSpan:
+    """Span that does nothing, used when metrics are disabled
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Metrics:
+    """Collects timing spans and counters and writes them as JSON lines to a size-rotated log file
+
+    Everything is a no-op as long as no log file is configured, so the instrumentation can stay in the hot paths.
+    Errors writing the log file are never raised, the first one is reported as warning to log.
+    """
+    DEFAULT_MAX_BYTES = 1024 * 1024
+    DEFAULT_BACKUPS = 3
+
+    def __init__(self, log=None):
+        """Default constructor, metrics start disabled
+        """
+        self.log = log
+        self._path = None
+        self._write_failed = False
+        self._max_bytes = self.DEFAULT_MAX_BYTES
+        self._backups = self.DEFAULT_BACKUPS
+        self._lock = threading.Lock()
+        self._spans = []
+        self._counters = {}
+
+    @property
+    def enabled(self):
+        return self._path is not None
+
+    def configure(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        """Enables writing to the given file or disables metrics if path is None
+        """
+        self._path = path
+        self._max_bytes = max(max_bytes, 1024)
+        self._backups = max(backups, 0)
+        self._write_failed = False
+        self.reset()
+
+    def reset(self):
+        """Discards everything that was collected but not written yet
+        """
+        with self._lock:
+            self._spans = []
+            self._counters = {}
+
+    def span(self, name, **attrs):
+        """Returns a context manager that records the time spent inside it under the given name
+        """
+        if self._path is None:
+            return _NULL_SPAN
+        return _Span(self, name, attrs)
+
+    def add_span(self, name, seconds, **attrs):
+        """Records an already measured span
+        """
+        if self._path is None:
+            return
+        span = {"name": name, "ms": round(seconds * 1000, 3)}
+        span.update(attrs)
+        with self._lock:
+            self._spans.append(span)
+
+    def count(self, name, value=1):
+        """Increments the counter with the given name
+        """
+        if self._path is None:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def flush(self, event, **attrs):
+        """Writes everything collected since the last flush as one JSON line tagged with event and resets
+
+        Nothing is written if nothing was collected.
+        """
+        if self._path is None:
+            return
+        with self._lock:
+            spans, self._spans = self._spans, []
+            counters, self._counters = self._counters, {}
+        if not spans and not counters:
+            return
+
+        import json
+
+        record = {"ts": round(time.time(), 3), "event": event, "pid": os.getpid()}
+        record.update(attrs)
+        record["spans"] = spans
+        record["counters"] = counters
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+
+        try:
+            self._rotate(len(line))
+            with open(self._path, "a", encoding="utf-8") as log_file:
+                log_file.write(line)
+        except OSError as exc:
+            # e.g. another program holds the file open, the record is dropped
+            if not self._write_failed and self.log is not None:
+                self.log.warn("Writing metrics to", self._path, "failed:", exc)
+            self._write_failed = True
+
+    def _rotate(self, incoming):
+        """Shifts metrics.jsonl -> metrics.jsonl.1 -> ... when the current file would grow beyond its maximum size
+        """
+        try:
+            size = os.path.getsize(self._path)
+        except OSError:
+            return
+        if size + incoming <= self._max_bytes:
+            return
+
+        if self._backups == 0:
+            os.remove(self._path)
+            return
+
+        for i in range(self._backups - 1, 0, -1):
+            src = "{}.{}".format(self._path, i)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self._path, i + 1))
+        os.replace(self._path, self._path + ".1")
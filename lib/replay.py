@@ -0,0 +1,198 @@
+import gzip
+import json
+import time
+
+from .engine import parse_wmic_list, PROCESS_COLUMNS
+
+FORMAT_VERSION = 1
+
+
+class Recording:
+    """Raw enumeration inputs of one snapshot: process rows or wmic output, the Alt+Tab windows, the services and
+    icon results
+
+    Saved as gzip compressed JSON, process rows are stored as lists in the order of PROCESS_COLUMNS.
+    """
+    def __init__(self):
+        self.created = time.time()
+        self.source = None
+        self.rows = None
+        self.wmic_output = None
+        self.windows = []
+        self.window_titles = {}
+        self.services = None
+        self.icons = {}
+
+    def save(self, path):
+        data = {
+            "version": FORMAT_VERSION,
+            "created": round(self.created, 3),
+            "source": self.source,
+            "columns": PROCESS_COLUMNS,
+            "windows": [[hwnd, pid, self.window_titles.get(hwnd)] for hwnd, pid in self.windows],
+            "icons": self.icons,
+        }
+        if self.services is not None:
+            data["services"] = [[pid, name] for pid, name in self.services]
+        if self.wmic_output is not None:
+            data["wmic_output"] = self.wmic_output
+        else:
+            data["processes"] = [[row.get(column) for column in PROCESS_COLUMNS] for row in self.rows or ()]
+
+        with gzip.open(path, "wt", encoding="utf-8") as snap_file:
+            json.dump(data, snap_file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        """Reads a recording, raises ValueError if the file has an unknown format version
+        """
+        with gzip.open(path, "rt", encoding="utf-8") as snap_file:
+            data = json.load(snap_file)
+
+        version = data.get("version")
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported snapshot format version {} in {}".format(version, path))
+
+        recording = cls()
+        recording.created = data["created"]
+        recording.source = data["source"]
+        if "wmic_output" in data:
+            recording.wmic_output = data["wmic_output"]
+        else:
+            columns = data["columns"]
+            # columns that were added after the recording was made are left empty
+            empty = dict.fromkeys(PROCESS_COLUMNS)
+            recording.rows = [dict(empty, **dict(zip(columns, values))) for values in data["processes"]]
+        for hwnd, pid, title in data["windows"]:
+            recording.windows.append((hwnd, pid))
+            if title is not None:
+                recording.window_titles[hwnd] = title
+        if "services" in data:
+            recording.services = [(pid, name) for pid, name in data["services"]]
+        recording.icons = data["icons"]
+        return recording
+
+
+class RecordingProcessBackend:
+    """Wraps a process backend and records its raw output, the wmic output is kept unparsed
+    """
+    def __init__(self, backend, recording):
+        self._backend = backend
+        self._recording = recording
+        self.source = getattr(backend, "source", None)
+        recording.source = self.source
+
+    def list_processes(self):
+        if hasattr(self._backend, "list_output"):
+            outstr = self._backend.list_output()
+            self._recording.wmic_output = outstr or ""
+            return parse_wmic_list(outstr) if outstr else []
+
+        rows = self._backend.list_processes()
+        self._recording.rows = rows
+        return rows
+
+    def get_process(self, pid):
+        return self._backend.get_process(pid)
+
+    def is_running(self, pid):
+        return self._backend.is_running(pid)
+
+
+class RecordingWindowBackend:
+    """Wraps a window backend and records the windows and the titles that were requested
+    """
+    def __init__(self, backend, recording):
+        self._backend = backend
+        self._recording = recording
+
+    def list_windows(self):
+        windows = self._backend.list_windows()
+        self._recording.windows = list(windows)
+        return windows
+
+    def window_text(self, hwnd):
+        title = self._backend.window_text(hwnd)
+        self._recording.window_titles[hwnd] = title
+        return title
+
+
+class RecordingServiceBackend:
+    """Wraps a service backend and records the services
+    """
+    def __init__(self, backend, recording):
+        self._backend = backend
+        self._recording = recording
+
+    def list_services(self):
+        services = self._backend.list_services()
+        self._recording.services = list(services)
+        return services
+
+
+class FixtureServiceBackend:
+    """Service backend that delivers a fixed list of (pid, service name)
+    """
+    def __init__(self, services):
+        self._services = list(services or ())
+
+    def list_services(self):
+        return self._services
+
+
+class ReplayProcessBackend:
+    """Process backend that delivers the processes of a recording, recorded wmic output is parsed again
+    """
+    def __init__(self, recording):
+        self._recording = recording
+        self.source = recording.source
+
+    def list_processes(self):
+        if self._recording.wmic_output is not None:
+            return parse_wmic_list(self._recording.wmic_output)
+        return self._recording.rows
+
+    def get_process(self, pid):
+        return next((row for row in self.list_processes() if row["ProcessId"] == pid), None)
+
+    def is_running(self, pid):
+        return self.get_process(pid) is not None
+
+
+class ReplayWindowBackend:
+    """Window backend that delivers the windows of a recording
+    """
+    def __init__(self, recording):
+        self._recording = recording
+
+    def list_windows(self):
+        return self._recording.windows
+
+    def window_text(self, hwnd):
+        if hwnd not in self._recording.window_titles:
+            raise OSError("No recorded title for window {}".format(hwnd))
+        return self._recording.window_titles[hwnd]
+
+
+class ReplayIcon:
+    """Stand-in for an icon handle
+    """
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+    def free(self):
+        pass
+
+
+class ReplayIconLoader:
+    """Icon loader for IconCache that fails for every path whose icon failed to load while recording
+    """
+    def __init__(self, recording):
+        self._recording = recording
+
+    def __call__(self, path):
+        if not self._recording.icons.get(path, True):
+            raise ValueError("Icon loading failed while recording: {}".format(path))
+        return ReplayIcon(path)
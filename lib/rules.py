@@ -0,0 +1,108 @@
+import fnmatch
+import re
+
+
+class Matcher:
+    """Compiled set of image name globs, path prefixes and session ids, all case insensitive
+
+    The globs are joined into one regular expression, the prefixes into one tuple for str.startswith.
+    """
+    __slots__ = ("names", "paths", "sessions", "_name_re", "_path_prefixes")
+
+    def __init__(self, names=(), paths=(), sessions=()):
+        self.names = [name for name in names if name]
+        self.paths = [path for path in paths if path]
+        self.sessions = frozenset(sessions)
+        self._name_re = None
+        if self.names:
+            self._name_re = re.compile("|".join("(?:{})".format(fnmatch.translate(name)) for name in self.names),
+                                       re.IGNORECASE)
+        self._path_prefixes = tuple(path.lower() for path in self.paths)
+
+    def __bool__(self):
+        return bool(self.names or self.paths or self.sessions)
+
+    def match(self, name, path, session):
+        """Returns true if the image name, the executable path or the session id matches any of the rules
+        """
+        if name and self._name_re is not None and self._name_re.match(name):
+            return True
+        if path and self._path_prefixes and path.lower().startswith(self._path_prefixes):
+            return True
+        return session is not None and session in self.sessions
+
+
+def _wql_literal(value):
+    return "'{}'".format(value.replace("\\", "\\\\").replace("'", "\\'"))
+
+
+def _wql_like(glob):
+    """Translates a glob into a WQL LIKE pattern, sets like [abc] mean the same in both
+    """
+    pattern = []
+    previous = None
+    for char in glob:
+        if char == "*":
+            pattern.append("%")
+        elif char == "?":
+            pattern.append("_")
+        elif char in "%_":
+            pattern.append("[{}]".format(char))
+        elif char == "!" and previous == "[":
+            pattern.append("^")
+        else:
+            pattern.append(char)
+        previous = char
+    return "".join(pattern)
+
+
+def _wql_name_condition(name):
+    if "*" in name or "?" in name or "[" in name:
+        return "Name LIKE {}".format(_wql_literal(_wql_like(name)))
+    return "Name = {}".format(_wql_literal(name))
+
+
+class ProcessRules:
+    """Include, exclude and protect rules for processes
+
+    Excluded (or not included, if there are include rules) processes never make it into the snapshot. Protected
+    processes are listed, but never killed.
+    """
+    def __init__(self, include=None, exclude=None, protect=None):
+        self.include = include or Matcher()
+        self.exclude = exclude or Matcher()
+        self.protect = protect or Matcher()
+
+    def __bool__(self):
+        return bool(self.include or self.exclude or self.protect)
+
+    def excluded(self, name, path, session):
+        """Returns true if the process should not be listed
+        """
+        if self.include and not self.include.match(name, path, session):
+            return True
+        return bool(self.exclude) and self.exclude.match(name, path, session)
+
+    def protected(self, name, path, session=None):
+        """Returns true if the process must not be killed
+        """
+        return bool(self.protect) and self.protect.match(name, path, session)
+
+    def wql_condition(self):
+        """Returns a WQL condition that lets WMI (or wmic) drop excluded processes right in the query or None
+
+        Only image names and session ids are translated, path prefixes are left to excluded() because
+        ExecutablePath is often NULL.
+        """
+        conditions = []
+        if self.exclude.names:
+            conditions.append("NOT ({})".format(" OR ".join(_wql_name_condition(name)
+                                                            for name in self.exclude.names)))
+        if self.exclude.sessions:
+            conditions.extend("SessionId <> {:d}".format(session) for session in sorted(self.exclude.sessions))
+        if self.include.sessions and not self.include.names and not self.include.paths:
+            conditions.append("({})".format(" OR ".join("SessionId = {:d}".format(session)
+                                                        for session in sorted(self.include.sessions))))
+        if self.include.names and not self.include.paths and not self.include.sessions:
+            conditions.append("({})".format(" OR ".join(_wql_name_condition(name) for name in self.include.names)))
+        return " AND ".join(conditions) or None
@@ -0,0 +1,367 @@
+import ctypes as ct
+import types
+
+from .alttab import AltTab
+from .engine import parse_wmic_list, PROCESS_COLUMNS
+
+# Nothing in here touches the windows api, subprocess or comtypes at import time, everything is resolved on first
+# use to keep loading the plugin cheap.
+
+PROCESS_TERMINATE = 0x0001
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+SYNCHRONIZE = 0x00100000
+WM_CLOSE = 0x0010
+SC_MANAGER_ENUMERATE_SERVICE = 0x0004
+SC_ENUM_PROCESS_INFO = 0
+SERVICE_WIN32 = 0x00000030
+SERVICE_ACTIVE = 0x00000001
+ERROR_MORE_DATA = 234
+
+_api = None
+_com_cl = None
+
+
+def api():
+    """Returns the win32 functions used by the backends, they are bound on the first call
+    """
+    global _api
+    if _api is None:
+        import ctypes.wintypes
+
+        command_line_to_argv = ct.windll.shell32.CommandLineToArgvW
+        command_line_to_argv.argtypes = [ctypes.wintypes.LPCWSTR, ct.POINTER(ct.c_int)]
+        command_line_to_argv.restype = ct.POINTER(ctypes.wintypes.LPWSTR)
+
+        post_message = ct.windll.user32.PostMessageW
+        post_message.argtypes = [ctypes.wintypes.HWND, ct.c_uint, ctypes.wintypes.WPARAM, ctypes.wintypes.LPARAM]
+        post_message.restype = ct.c_long
+
+        class SERVICE_STATUS_PROCESS(ct.Structure):
+            _fields_ = [("dwServiceType", ctypes.wintypes.DWORD),
+                        ("dwCurrentState", ctypes.wintypes.DWORD),
+                        ("dwControlsAccepted", ctypes.wintypes.DWORD),
+                        ("dwWin32ExitCode", ctypes.wintypes.DWORD),
+                        ("dwServiceSpecificExitCode", ctypes.wintypes.DWORD),
+                        ("dwCheckPoint", ctypes.wintypes.DWORD),
+                        ("dwWaitHint", ctypes.wintypes.DWORD),
+                        ("dwProcessId", ctypes.wintypes.DWORD),
+                        ("dwServiceFlags", ctypes.wintypes.DWORD)]
+
+        class ENUM_SERVICE_STATUS_PROCESSW(ct.Structure):
+            _fields_ = [("lpServiceName", ctypes.wintypes.LPWSTR),
+                        ("lpDisplayName", ctypes.wintypes.LPWSTR),
+                        ("ServiceStatusProcess", SERVICE_STATUS_PROCESS)]
+
+        advapi = ct.WinDLL("advapi32", use_last_error=True)
+        open_sc_manager = advapi.OpenSCManagerW
+        open_sc_manager.argtypes = [ctypes.wintypes.LPCWSTR, ctypes.wintypes.LPCWSTR, ctypes.wintypes.DWORD]
+        open_sc_manager.restype = ctypes.wintypes.HANDLE
+
+        enum_services = advapi.EnumServicesStatusExW
+        enum_services.argtypes = [ctypes.wintypes.HANDLE, ct.c_int, ctypes.wintypes.DWORD, ctypes.wintypes.DWORD,
+                                  ct.c_void_p, ctypes.wintypes.DWORD, ctypes.wintypes.LPDWORD,
+                                  ctypes.wintypes.LPDWORD, ctypes.wintypes.LPDWORD, ctypes.wintypes.LPCWSTR]
+        enum_services.restype = ctypes.wintypes.BOOL
+
+        close_service_handle = advapi.CloseServiceHandle
+        close_service_handle.argtypes = [ctypes.wintypes.HANDLE]
+        close_service_handle.restype = ctypes.wintypes.BOOL
+
+        get_process_times = ct.windll.kernel32.GetProcessTimes
+        get_process_times.argtypes = [ctypes.wintypes.HANDLE] + [ct.POINTER(ctypes.wintypes.FILETIME)] * 4
+        get_process_times.restype = ctypes.wintypes.BOOL
+
+        _api = types.SimpleNamespace(kernel=ct.windll.kernel32,
+                                     OpenSCManagerW=open_sc_manager,
+                                     EnumServicesStatusExW=enum_services,
+                                     CloseServiceHandle=close_service_handle,
+                                     ENUM_SERVICE_STATUS_PROCESSW=ENUM_SERVICE_STATUS_PROCESSW,
+                                     CommandLineToArgvW=command_line_to_argv,
+                                     PostMessageW=post_message,
+                                     GetProcessTimes=get_process_times,
+                                     FILETIME=ctypes.wintypes.FILETIME,
+                                     DWORD=ctypes.wintypes.DWORD,
+                                     LPCWSTR=ctypes.wintypes.LPCWSTR)
+    return _api
+
+
+def com_client():
+    """Returns the comtypes.client module or None if comtypes is not available
+    """
+    global _com_cl
+    if _com_cl is None:
+        try:
+            import comtypes.client as com_cl
+        except ImportError:
+            com_cl = False
+        _com_cl = com_cl
+    return _com_cl or None
+
+
+def split_command_line(cmdline):
+    """Splits a command line into its arguments the same way windows does (CommandLineToArgvW)
+    """
+    win = api()
+    argc = ct.c_int(0)
+    argv = win.CommandLineToArgvW(win.LPCWSTR(cmdline), ct.byref(argc))
+    if not argv:
+        return []
+    try:
+        return [argv[i] for i in range(0, argc.value)]
+    finally:
+        win.kernel.LocalFree(argv)
+
+
+def _run_wmic(args, log):
+    """Calls wmic.exe with the arguments and returns its decoded output or None
+    """
+    import subprocess
+
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    output, err = subprocess.Popen(["wmic"] + args,
+                                   stdout=subprocess.PIPE,
+                                   # universal_newlines=True,
+                                   shell=False,
+                                   startupinfo=startupinfo).communicate()
+    # log error if any
+    if err:
+        log.err(err)
+
+    output = output.replace(b"\r\r", b"\r")
+    for enc in ["cp437", "cp850", "cp1252", "utf8"]:
+        try:
+            return output.decode(enc)
+        except UnicodeDecodeError:
+            log.dbg(enc, "threw exception")
+
+    log.warn("decoding of output failed")
+    return None
+
+
+class WmiProcessBackend:
+    """Gets the running processes with the Windows Management COMObject (WMI)
+    """
+    source = "wmi"
+
+    def __init__(self, wmi, log, where=None):
+        self._wmi = wmi
+        self._log = log
+        self.where = where
+
+    @classmethod
+    def create(cls, log, where=None):
+        """Returns the backend or None if WMI is not available
+
+        where is a WQL condition that filters the process list right in the query
+        """
+        com_cl = com_client()
+        if not com_cl:
+            return None
+        wmi = com_cl.CoGetObject("winmgmts:")
+        if not wmi:
+            return None
+        return cls(wmi, log, where)
+
+    def list_processes(self):
+        query = "SELECT {} FROM Win32_Process".format(", ".join(PROCESS_COLUMNS))
+        if self.where:
+            query += " WHERE " + self.where
+        result_wmi = self._wmi.ExecQuery(query)
+        rows = []
+        for proc in result_wmi:
+            props = proc.Properties_
+            rows.append({column: props[column].Value for column in PROCESS_COLUMNS})
+        return rows
+
+    def get_process(self, pid):
+        result_wmi = self._wmi.ExecQuery("SELECT {} FROM Win32_Process WHERE ProcessId = {}".format(
+            ", ".join(PROCESS_COLUMNS), int(pid)))
+        for proc in result_wmi:
+            props = proc.Properties_
+            return {column: props[column].Value for column in PROCESS_COLUMNS}
+        return None
+
+    def is_running(self, pid):
+        # the check runs in worker threads, so it uses its own COMObject
+        wmi = com_client().CoGetObject("winmgmts:")
+        result_wmi = wmi.ExecQuery("SELECT ProcessId FROM Win32_Process WHERE ProcessId = {}".format(pid))
+        running = len(result_wmi) > 0
+        self._log.dbg("(wmi) process with id ", pid, "running" if running else "not running")
+        return running
+
+
+class WmicProcessBackend:
+    """FALLBACK
+
+    Gets the running processes with windows' "wmic.exe" tool
+    """
+    source = "wmic"
+
+    def __init__(self, log, where=None):
+        self._log = log
+        self.where = where
+
+    def list_output(self):
+        """Returns the raw (decoded) output of wmic for the process list
+        """
+        where = ["where", self.where] if self.where else []
+        return _run_wmic(["process"]
+                         + where
+                         + ["get",
+                            "ProcessId,Caption,",
+                            "Name,ExecutablePath,CommandLine,SessionId,CreationDate",
+                            "/FORMAT:LIST"],
+                         self._log)
+
+    def list_processes(self):
+        outstr = self.list_output()
+        if not outstr:
+            return []
+        return parse_wmic_list(outstr)
+
+    def get_process(self, pid):
+        outstr = _run_wmic(["process",
+                            "where",
+                            "ProcessId={}".format(int(pid)),
+                            "get",
+                            "ProcessId,Caption,",
+                            "Name,ExecutablePath,CommandLine,SessionId,CreationDate",
+                            "/FORMAT:LIST"],
+                           self._log)
+        rows = parse_wmic_list(outstr) if outstr else []
+        return rows[0] if rows else None
+
+    def is_running(self, pid):
+        outstr = _run_wmic(["process",
+                            "where",
+                            "ProcessId={}".format(pid),
+                            "get",
+                            "ProcessId",
+                            "/FORMAT:LIST"],
+                           self._log)
+        if not outstr:
+            return False
+
+        running = "ProcessId={}".format(pid) in outstr.splitlines()
+        self._log.dbg("(wmic) process with id ", pid, "running" if running else "not running")
+        return running
+
+
+class AltTabWindowBackend:
+    """Gets the windows that are shown in the Alt+Tab panel
+    """
+    def list_windows(self):
+        windows = []
+        for hwnd in AltTab.list_alttab_windows():
+            try:
+                _, proc_id = AltTab.get_window_thread_process_id(hwnd)
+            except OSError:
+                continue
+            windows.append((hwnd, proc_id))
+        return windows
+
+    def window_text(self, hwnd):
+        return AltTab.get_window_text(hwnd)
+
+
+class ScmServiceBackend:
+    """Gets the running services and their process ids with one EnumServicesStatusEx call on the Service Control
+    Manager
+    """
+    def list_services(self):
+        """Returns a list of (pid, service name) for all active win32 services
+
+        Raises a OSError exception on error.
+        """
+        win = api()
+        scm = win.OpenSCManagerW(None, None, SC_MANAGER_ENUMERATE_SERVICE)
+        if not scm:
+            raise ct.WinError(ct.get_last_error())
+        try:
+            needed = ct.wintypes.DWORD(0)
+            returned = ct.wintypes.DWORD(0)
+            resume = ct.wintypes.DWORD(0)
+            size = 64 * 1024
+            services = []
+            while True:
+                buff = ct.create_string_buffer(size)
+                success = win.EnumServicesStatusExW(scm, SC_ENUM_PROCESS_INFO, SERVICE_WIN32, SERVICE_ACTIVE,
+                                                    buff, size, ct.byref(needed), ct.byref(returned),
+                                                    ct.byref(resume), None)
+                error = ct.get_last_error()
+                if not success and error != ERROR_MORE_DATA:
+                    raise ct.WinError(error)
+
+                entries = ct.cast(buff, ct.POINTER(win.ENUM_SERVICE_STATUS_PROCESSW))
+                for i in range(returned.value):
+                    entry = entries[i]
+                    services.append((entry.ServiceStatusProcess.dwProcessId, entry.lpServiceName))
+
+                if success:
+                    return services
+                # the remaining entries are delivered in the next call, starting at resume
+                size = max(size, needed.value)
+        finally:
+            win.CloseServiceHandle(scm)
+
+
+class Win32KillBackend:
+    """Primitives of the windows api that are needed to kill processes
+    """
+    def __init__(self, log):
+        self._log = log
+
+    @property
+    def _kernel(self):
+        return api().kernel
+
+    def open(self, pid, query=False):
+        """Opens the process for killing and waiting, with query also for creation_time()
+
+        The query right is only asked for if needed, because OpenProcess fails entirely if any right is denied.
+        """
+        access = PROCESS_TERMINATE | SYNCHRONIZE
+        if query:
+            access |= PROCESS_QUERY_LIMITED_INFORMATION
+        handle = self._kernel.OpenProcess(access, False, pid)
+        if not handle:
+            self._log.dbg("OpenProcess failed, ErrorCode:", self._kernel.GetLastError())
+        return handle
+
+    def close(self, handle):
+        self._kernel.CloseHandle(handle)
+
+    def creation_time(self, handle):
+        """Returns the creation time of the process as FILETIME value (100ns intervals since 1601-01-01 UTC) or None
+        """
+        win = api()
+        created, exited, kernel_time, user_time = (win.FILETIME() for _ in range(4))
+        if not win.GetProcessTimes(handle, ct.byref(created), ct.byref(exited), ct.byref(kernel_time),
+                                   ct.byref(user_time)):
+            self._log.dbg("GetProcessTimes failed, ErrorCode:", self._kernel.GetLastError())
+            return None
+        return (created.dwHighDateTime << 32) | created.dwLowDateTime
+
+    def post_close(self, hwnd):
+        success = api().PostMessageW(hwnd, ct.c_uint(WM_CLOSE), 0, 0)
+        self._log.dbg("PostMessageW return:", success)
+
+    def wait(self, handle, timeout_ms):
+        result = self._kernel.WaitForSingleObject(handle, api().DWORD(timeout_ms))
+        self._log.dbg("WaitForSingleObject returned", result, "ErrorCode:", self._kernel.GetLastError())
+        return result
+
+    def remote_exit(self, handle):
+        thread = self._kernel.CreateRemoteThread(handle, None, 0, self._kernel.ExitProcess, ct.c_uint(1), 0)
+        if not thread:
+            self._log.dbg("CreateRemoteThread failed, ErrorCode:", self._kernel.GetLastError())
+            return False
+        self._kernel.CloseHandle(thread)
+        return True
+
+    def terminate(self, handle):
+        success = self._kernel.TerminateProcess(handle, 1)
+        if not success:
+            self._log.warn("TerminateProcess failed, ErrorCode:", self._kernel.GetLastError())
+        return bool(success)